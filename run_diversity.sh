@@ -3,6 +3,10 @@
 # start_time
 start_time=$(date +%s)
 
+# the models run on the first visible GPU, --workers N puts one worker on each of the first N visible GPUs,
+# so list them all, e.g. CUDA_VISIBLE_DEVICES=0,1,2,3 for --workers 4
+export CUDA_VISIBLE_DEVICES=${CUDA_VISIBLE_DEVICES:-0}
+
 # mode (EN/ZH)
 MODE=EN
 
@@ -32,7 +36,6 @@ python -m scripts.diversity.diversity_score \
 
 # In ZH mode, the class_items list can be extended to include "multilingualism".
 
-rm -rf tmp_*
 # end_time
 end_time=$(date +%s)
 duration=$((end_time - start_time))
@@ -3,6 +3,10 @@
 # start_time
 start_time=$(date +%s)
 
+# the models run on the first visible GPU, --workers N puts one worker on each of the first N visible GPUs,
+# so list them all, e.g. CUDA_VISIBLE_DEVICES=0,1,2,3 for --workers 4
+export CUDA_VISIBLE_DEVICES=${CUDA_VISIBLE_DEVICES:-0}
+
 # mode (EN/ZH)
 MODE=EN
 
@@ -13,6 +17,21 @@ IMAGE_DIR=""
 MODEL_NAMES=("janus-pro")
 # model_names=("gpt-4o" "imagen4")
 
+# decoded tile cache shared by all metrics
+TILE_CACHE_DIR="tile_cache"
+
+# journal of finished results, rerun with RESUME="--resume" after an interruption
+# or to score only the models, grids and images that are new or changed
+JOURNAL="results/journal_${MODE}.jsonl"
+RESUME=""
+
+# VLM answers of alignment and text, reused by later runs
+ANSWER_CACHE="vlm_answer_cache.sqlite"
+
+# to split one evaluation across machines, add --shard_index i --num_shards N to the command below,
+# then gather results/partials and run: python -m scripts.utils.merge_shards --mode "$MODE"
+# --workers N, one process per GPU, applies to the scoring scripts run on their own and needs N GPUs in CUDA_VISIBLE_DEVICES
+
 # image grid
 IMAGE_GRIDS=("2,2")
 # IMAGE_GRIDS=("2,2" "1,4")
@@ -21,62 +40,24 @@ echo "Running all evaluation scripts"
 
 pip install transformers==4.50.0
 
-# Alignment Score
-
-echo "It's alignment time."
+# All metrics run in one process, each model is loaded once and freed after its last metric.
+# --metrics picks a subset, the image directory of each metric is found under IMAGE_DIR.
 
-python -m scripts.alignment.alignment_score \
+python -m scripts.utils.run_metrics \
+  --metrics alignment text diversity style reasoning \
   --mode "$MODE" \
   --image_dirname "$IMAGE_DIR" \
   --model_names "${MODEL_NAMES[@]}" \
-  --image_grid "${IMAGE_GRID[@]}" \
-  --class_items "anime" "human" "object" \
-
-# In ZH mode, the class_items list can be extended to include "multilingualism".
-
-# Text Score
-
-echo "It's text time."
-
-python -m scripts.text.text_score \
-  --mode "$MODE" \
-  --image_dirname "$IMAGE_DIR/text" \
-  --model_names "${MODEL_NAMES[@]}" \
-  --image_grid "${IMAGE_GRID[@]}" \
-
-# Diversity Score
-
-echo "It's diversity time."
+  --image_grid "${IMAGE_GRIDS[@]}" \
+  --tile_cache_dir "$TILE_CACHE_DIR" \
+  --answer_cache "$ANSWER_CACHE" \
+  --journal "$JOURNAL" $RESUME \
+  --alignment_class_items "anime" "human" "object" \
+  --diversity_class_items "anime" "human" "object" "text" "reasoning" \
 
-python -m scripts.diversity.diversity_score \
-  --mode "$MODE" \
-  --image_dirname "$IMAGE_DIR" \
-  --model_names "${MODEL_NAMES[@]}" \
-  --image_grid "${IMAGE_GRID[@]}" \
-  --class_items "anime" "human" "object" "text" "reasoning" \
-
-# Style Score
-
-echo "It's style time."
-
-python -m scripts.style.style_score \
-  --mode "$MODE" \
-  --image_dirname "$IMAGE_DIR/anime" \
-  --model_names "${MODEL_NAMES[@]}" \
-  --image_grid "${IMAGE_GRID[@]}" \
-
-# Reasoning Score
-
-echo "It's reasoning time."
-
-python -m scripts.reasoning.reasoning_score \
-  --mode "$MODE" \
-  --image_dirname "${IMAGE_DIR}/reasoning" \
-  --model_names "${MODEL_NAMES[@]}" \
-  --image_grid "${IMAGE_GRID[@]}" \
+# In ZH mode, the alignment class items can be extended to include "multilingualism".
 
 
-rm -rf tmp_*
 # end_time
 end_time=$(date +%s)
 duration=$((end_time - start_time))
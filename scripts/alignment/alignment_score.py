@@ -1,72 +1,194 @@
 from PIL import Image
 Image.MAX_IMAGE_PIXELS = None
 import os
-import megfile
-import shutil
-import pandas as pd
 from tqdm import tqdm
-from scripts.utils.utils import parse_args, split_mxn_grid, save2csv, on_rm_error
+from scripts.utils.tile_cache import build_tile_cache
+from scripts.utils.loader import journaled_loader, tile_loader
+from scripts.utils.pipeline import Pipeline, Stage
+from scripts.utils.image_index import build_image_index
+from scripts.utils.manifest import load_manifest
+from scripts.utils.journal import build_journal
+from scripts.utils.parallel import run_metric
+from scripts.utils.utils import parse_args, save2csv
 
-import json
-from copy import deepcopy
-from scripts.utils.inference import Qwen2_5VLBatchInferencer
+import numpy as np
+from scripts.utils.backends import build_backend
 
 import datetime
 current_time = datetime.datetime.now()
 formatted_time = current_time.strftime("%Y-%m-%d_%H-%M-%S")
 
-inferencer = Qwen2_5VLBatchInferencer("Qwen/Qwen2.5-VL-7B-Instruct")
+def alignment_score(inferencer, split_img_list, questions, dependencies, args):
+    return alignment_scores(inferencer, {None: split_img_list}, questions, dependencies, args)[None]
 
-def alignment_score(img_path, questions, dependencies, img_grid, cache_dir):
-    score = {}
-    
-    if len(img_path) == 1:
-        split_img_list = split_mxn_grid(img_path[0], img_grid, cache_dir)
-        if len(split_img_list) == 0:
-            return None    
+def compile_questions(questions, dependencies):
+    # rows follow the question order, parents[q, p] is set when question p is a parent of q
+    ids = list(questions)
+    rows = {id: row for row, id in enumerate(ids)}
+    parents = np.zeros((len(ids), len(ids)), dtype=bool)
+    for id, parent_ids in dependencies.items():
+        for parent_id in parent_ids:
+            # 0 marks a question without parents, unknown ids are ignored
+            if id in rows and parent_id in rows:
+                parents[rows[id], rows[parent_id]] = True
+    return ids, parents
+
+def alignment_scores(inferencer, tiles_per_model, questions, dependencies, args):
+    # tiles of every model for one prompt, so each question is asked about all of them in one batch
+    results = {model_name: None for model_name in tiles_per_model}
+    tiles_per_model = {model_name: tiles for model_name, tiles in tiles_per_model.items() if tiles}
+    if len(tiles_per_model) == 0:
+        return results
+
+    ids, parents = compile_questions(questions, dependencies)
+    # one column per (model, tile), answers stay NaN for pairs that were never asked
+    columns = [(model_name, img_idx) for model_name, tiles in tiles_per_model.items() for img_idx in range(len(tiles))]
+    answers = np.full((len(ids), len(columns)), np.nan)
+    yes_probs = np.full((len(ids), len(columns)), np.nan)
+
+    # vision features of each tile, shared by all questions asked about it
+    vision_cache = {} if args.reuse_vision else None
+
+    def ask(mask):
+        rows, cols = np.nonzero(mask)
+        pairs = [(tiles_per_model[columns[col][0]][columns[col][1]], questions[ids[row]]) for row, col in zip(rows, cols)]
+        if args.semantic_mode == "logits":
+            outputs = inferencer.infer_semantic_probs(pairs, args.batch_size, vision_cache)
+        else:
+            outputs = [(ans, np.nan) for ans in inferencer.infer_semantic_pairs(pairs, args.batch_size)]
+        answers[rows, cols] = [float(ans == "Yes") for ans, _ in outputs]
+        yes_probs[rows, cols] = [yes_prob for _, yes_prob in outputs]
+
+    if args.lazy_dependencies:
+        ask_with_dependencies(ask, answers, parents)
     else:
-        return None
-    
-    for id, question in questions.items():
-        images_path = split_img_list
-        batch_answer = inferencer.infer_semantic(images_path, question)
-        score[id] = [float(ans == "Yes") for ans in batch_answer]
-        
-    filter_score = deepcopy(score)
-    for img_idx in range(len(split_img_list)):
-        for id, parent_ids in dependencies.items():
-            any_parent_answered_no = False
-            for parent_id in parent_ids:
-                if parent_id == 0:
-                    continue
-                try:
-                    if score[parent_id][img_idx] == 0:
-                        any_parent_answered_no = True
-                        break
-                    else:
-                        continue
-                except:
-                    print("The score is not a number.")
-            if any_parent_answered_no:
-                filter_score[id][img_idx] = 0
-
-    sum_of_filter_score = [0] * len(split_img_list)
-    for question_id in range(len(filter_score)):
-        for img_idx in range(len(split_img_list)):
-            sum_of_filter_score[img_idx] += filter_score[question_id + 1][img_idx]
-    
-    sum_of_filter_score = [img_score / len(filter_score) for img_score in sum_of_filter_score]
-    
-    return sum(sum_of_filter_score)  / len(sum_of_filter_score) 
-    
-def main():
-    args = parse_args()
-    
-    cache_dir = f"tmp_{formatted_time}"
-    os.makedirs(cache_dir, exist_ok=True)
+        ask(np.ones(answers.shape, dtype=bool))
+
+    model_columns = {}
+    for col, (model_name, _) in enumerate(columns):
+        model_columns.setdefault(model_name, []).append(col)
+    soft = args.soft_alignment and args.semantic_mode == "logits"
+    scores = filter_and_average(
+        [answers[:, cols] for cols in model_columns.values()],
+        [parents] * len(model_columns),
+        [yes_probs[:, cols] for cols in model_columns.values()] if soft else None,
+    )
+    results.update(zip(model_columns, scores))
+    return results
+
+def ask_with_dependencies(ask, answers, parents):
+    # A (tile, question) answer is only needed if every parent answered "Yes" for that tile,
+    # or if a child still needs it to decide whether it is filtered. The filter reads the raw
+    # parent answers, so evaluating round by round on demand keeps the final scores unchanged.
+    parents = parents.astype(np.int32)
+    while True:
+        unknown = np.isnan(answers)
+        blocked = parents @ (answers == 0).astype(np.int32) > 0
+        waiting = parents @ unknown.astype(np.int32) > 0
+        demanded = unknown & ~blocked & ~waiting
+        demanded |= unknown & (parents.T @ (~blocked & waiting).astype(np.int32) > 0)
+        if not demanded.any():
+            return
+        ask(demanded)
+
+def filter_and_average(answers, parents, values=None):
+    # answers: (questions x tiles) binary answers of each prompt instance, parents: the matching
+    # adjacency matrices, values: optional soft scores to average instead of the answers.
+    # Instances are padded into one array so any number of prompts is filtered at once.
+    num_questions = np.array([len(a) for a in answers])
+    num_tiles = np.array([a.shape[1] for a in answers])
+    shape = (len(answers), num_questions.max(), num_tiles.max())
+
+    answered_no = np.zeros(shape, dtype=np.float32)
+    parent_matrix = np.zeros((len(answers), shape[1], shape[1]), dtype=np.float32)
+    filter_score = np.zeros(shape)
+    for idx, (q, t) in enumerate(zip(num_questions, num_tiles)):
+        answered_no[idx, :q, :t] = answers[idx] == 0
+        parent_matrix[idx, :q, :q] = parents[idx]
+        filter_score[idx, :q, :t] = answers[idx] if values is None else values[idx]
 
-    question_dependency_dir = "scripts/alignment"
+    # a question is filtered to 0 on a tile when any of its parents answered "No" there
+    blocked = np.einsum("pqr,prt->pqt", parent_matrix, answered_no) > 0
+    filter_score[blocked] = 0
+
+    sum_of_filter_score = filter_score.sum(axis=1) / num_questions[:, None]
+    return [sum(tile_scores[:t]) / t for tile_scores, t in zip(sum_of_filter_score.tolist(), num_tiles.tolist())]
     
+def score(args, manifest, sharding):
+    tile_cache = build_tile_cache(args)
+    inferencer = build_backend(args, "vlm", model_path="Qwen/Qwen2.5-VL-7B-Instruct", chat_templates=manifest.chat_templates)
+    journal = build_journal(args, "alignment", tile_cache, inferencer.model_id)
+    load = journaled_loader(journal, tile_loader(args, tile_cache))
+
+    # score of each prompt on each method, keyed by (model_name, f"{class_item}_{key}")
+    results = {}
+
+    for class_item in args.class_items:
+
+        print(f"We process {class_item} now.")
+
+        question_dependency = {key: item for key, item in manifest.prompts(class_item, "question").items() if sharding.owns(class_item, key)}
+
+        image_index = build_image_index(
+            {model_name: args.image_dirname + '/' + class_item + '/' + model_name for model_name in args.model_names},
+            question_dependency.keys(),
+        )
+
+        def prompt_image(key, model_id, model_name):
+            img_grid = (int(args.image_grid[model_id].split(',')[0]), int(args.image_grid[model_id].split(',')[-1]))
+            image_path = image_index[model_name].get(key, [])
+            return (image_path[0] if len(image_path) == 1 else None), img_grid
+
+        def load_prompt_tiles(work_item):
+            # (journal inputs, tiles), finished prompts come without tiles
+            key, model_id, model_name = work_item
+            return load(model_name, f"{class_item}_{key}", *prompt_image(key, model_id, model_name))
+
+        if args.cross_model_batching:
+            def load_all_model_tiles(key):
+                return {
+                    model_name: load_prompt_tiles((key, model_id, model_name))
+                    for model_id, model_name in enumerate(args.model_names)
+                }
+
+            def score_all_models(key, loaded):
+                item = question_dependency[key]
+                tiles_per_model = {model_name: tiles for model_name, (_, tiles) in loaded.items()}
+                scores = alignment_scores(inferencer, tiles_per_model, item["question"], item["dependency"], args)
+                return {model_name: (inputs, scores[model_name]) for model_name, (inputs, _) in loaded.items()}
+
+            pipeline = Pipeline(f"alignment {class_item}", [
+                Stage("load", load_all_model_tiles, "io", args.num_io_workers),
+                Stage("ask", score_all_models, "model"),
+            ], args.prefetch)
+
+            for key, scores in tqdm(pipeline.run(question_dependency.keys()), total=len(question_dependency), desc=f"Processing {class_item}"):
+
+                for model_name, (inputs, result) in scores.items():
+                    results[(model_name, f"{class_item}_{key}")] = journal.record(model_name, f"{class_item}_{key}", result, inputs)
+        else:
+            work_items = [(key, model_id, model_name) for key in question_dependency for model_id, model_name in enumerate(args.model_names)]
+            def score_prompt(work_item, loaded):
+                # finished prompts come without tiles and score None without asking anything
+                inputs, split_img_list = loaded
+                item = question_dependency[work_item[0]]
+                return inputs, alignment_score(inferencer, split_img_list, item["question"], item["dependency"], args)
+
+            pipeline = Pipeline(f"alignment {class_item}", [
+                Stage("load", load_prompt_tiles, "io", args.num_io_workers),
+                Stage("ask", score_prompt, "model"),
+            ], args.prefetch)
+
+            for (key, model_id, model_name), (inputs, result) in tqdm(pipeline.run(work_items), total=len(work_items), desc=f"Processing {class_item}"):
+
+                results[(model_name, f"{class_item}_{key}")] = journal.record(model_name, f"{class_item}_{key}", result, inputs)
+
+    journal.close()
+    inferencer.close()
+    return results
+
+def write_results(args, manifest, results):
+    import pandas as pd
     alignment_score_csv = f"results/alignment_score_{args.mode}_{formatted_time}.csv"
     alignment_prompt_score_csv = f"results/alignment_prompt_score_{args.mode}_{formatted_time}.csv"
     os.makedirs(os.path.dirname(alignment_score_csv), exist_ok=True)
@@ -75,35 +197,11 @@ def main():
     score_csv = pd.DataFrame(index=args.model_names, columns=["alignment"])
     # save the score of each prompt on each method to calculate average alignment score
     score_of_prompt_csv = pd.DataFrame(columns=args.model_names)
-    
-    for class_item in args.class_items:
-
-        print(f"We process {class_item} now.")
 
-        if args.mode == "EN":
-            question_dependency_json_dir = question_dependency_dir + '/Q_D/' + class_item + '.json'
-        else:
-            question_dependency_json_dir = question_dependency_dir + '/Q_D/' + class_item + '_zh.json'
- 
-        with open(question_dependency_json_dir, "r", encoding="utf-8") as f:
-            question_dependency = json.load(f)
-        
-        for key, item in tqdm(question_dependency.items(), desc=f"Processing {class_item}"):
-
-            if isinstance(item["question"], str):
-                item["question"] = {int(k): v for k, v in json.loads(item["question"]).items()}
-            if isinstance(item["dependency"], str):
-                item["dependency"] = {int(k): v for k, v in json.loads(item["dependency"]).items()}
-
-            for model_id, model_name in enumerate(args.model_names):
-                
-                img_grid = (int(args.image_grid[model_id].split(',')[0]), int(args.image_grid[model_id].split(',')[-1]))
-                 
-                image_path = megfile.smart_glob(args.image_dirname + '/' + class_item + '/' + model_name + '/' + key + '*')
-                
-                result = alignment_score(image_path, item["question"], item["dependency"], img_grid, cache_dir)
-                
-                score_of_prompt_csv.loc[f"{class_item}_{key}", model_name] = result
+    for class_item in args.class_items:
+        for key in manifest.prompts(class_item, "question"):
+            for model_name in args.model_names:
+                score_of_prompt_csv.loc[f"{class_item}_{key}", model_name] = results[(model_name, f"{class_item}_{key}")]
 
     mean_values = score_of_prompt_csv.mean()
     score_csv["alignment"] = mean_values.values
@@ -112,8 +210,11 @@ def main():
     score_of_prompt_csv = score_of_prompt_csv.sort_index()
     save2csv(score_of_prompt_csv, alignment_prompt_score_csv)
 
-    if os.path.exists(cache_dir):
-        shutil.rmtree(cache_dir, onerror=on_rm_error)
+def main():
+    args = parse_args()
+    manifest = load_manifest(args.mode, args.manifest)
+    run_metric(args, "alignment", manifest, score, write_results)
+
         
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -1,44 +1,43 @@
 from PIL import Image
 Image.MAX_IMAGE_PIXELS = None
 import os
-import megfile
-import shutil
-import pandas as pd
 from tqdm import tqdm
-from scripts.utils.utils import parse_args, split_mxn_grid, save2csv, on_rm_error
-
-import torchvision
-torchvision.disable_beta_transforms_warning()
-from dreamsim import dreamsim
+from scripts.utils.tile_cache import build_tile_cache
+from scripts.utils.loader import journaled_loader, tile_loader
+from scripts.utils.pipeline import Pipeline, Stage
+from scripts.utils.journal import build_journal
+from scripts.utils.manifest import load_manifest
+from scripts.utils.parallel import run_metric
+from scripts.utils.utils import parse_args, save2csv
+from scripts.utils.backends import build_backend
 
 import datetime
 current_time = datetime.datetime.now()
 formatted_time = current_time.strftime("%Y-%m-%d_%H-%M-%S")
 
-os.environ["CUDA_VISIBLE_DEVICES"] = "0"
-device = "cuda"
+def diversity_prompt_score(DreamSim_Model, split_img_list):
+    # None when there are not two tiles to compare
+    if len(split_img_list) <= 1:
+        return None
 
-model, preprocess = dreamsim(pretrained=True, device=device)
+    score = []
 
-def img_similar_score(image_1_path, image_2_path):
-    image_1 = preprocess(Image.open(image_1_path)).to(device)
-    image_2 = preprocess(Image.open(image_2_path)).to(device)
-    distance = model(image_1, image_2)     
-    return distance.item()
+    for i in range(len(split_img_list)):
+        for j in range(i+1, len(split_img_list)):
+            prob = DreamSim_Model.distance(split_img_list[i], split_img_list[j])
+            score.append(prob)
 
-def main():
-    args = parse_args()
-    
-    cache_dir = f"tmp_{formatted_time}"
-    os.makedirs(cache_dir, exist_ok=True)
-    
-    diversity_score_csv = f"results/diversity_score_{args.mode}_{formatted_time}.csv"
-    diversity_prompt_score_csv = f"results/diversity_prompt_score_{args.mode}_{formatted_time}.csv"
-    os.makedirs(os.path.dirname(diversity_score_csv), exist_ok=True)
+    return sum(score)/len(score)
 
-    column_items = args.class_items.copy().append("total average")
-    score_csv = pd.DataFrame(index=args.model_names, columns=column_items)
-    score_of_prompt_csv = pd.DataFrame(columns=args.model_names)
+def score(args, manifest, sharding):
+    import megfile
+    DreamSim_Model = build_backend(args, "image_distance")
+    tile_cache = build_tile_cache(args)
+    journal = build_journal(args, "diversity", tile_cache)
+    load = journaled_loader(journal, tile_loader(args, tile_cache, DreamSim_Model.input_size))
+
+    # average distance between the tiles of each prompt, keyed by (model_name, f"{class_item}_{id}")
+    results = {}
 
     for model_id, model_name in enumerate(args.model_names):
         
@@ -46,39 +45,64 @@ def main():
         
         img_grid = (int(args.image_grid[model_id].split(',')[0]), int(args.image_grid[model_id].split(',')[-1])) 
 
-        model_score = []
-        
         for class_item in args.class_items:
             
             print(f"We process {class_item} now.")
             
             image_dir = args.image_dirname + '/' + class_item + '/' + model_name
             img_list = megfile.smart_glob(image_dir + '/*')
-            img_list = sorted(img_list)
+            img_list = sorted(img_path for img_path in img_list if sharding.owns(class_item, img_path.split('/')[-1][:3]))
             
             print(f"We fetch {len(img_list)} images.")
             
+            def load_diversity_tiles(img_path):
+                return load(model_name, f"{class_item}_{img_path.split('/')[-1][:3]}", img_path, img_grid)
+
+            def score_diversity_tiles(img_path, loaded):
+                # finished prompts come without tiles
+                inputs, split_img_list = loaded
+                return inputs, None if split_img_list is None else diversity_prompt_score(DreamSim_Model, split_img_list)
+
+            pipeline = Pipeline(f"diversity {model_name} {class_item}", [
+                Stage("load", load_diversity_tiles, "io", args.num_io_workers),
+                Stage("distance", score_diversity_tiles, "model"),
+            ], args.prefetch)
+
+            for img_path, (inputs, avg_score) in tqdm(pipeline.run(img_list), total=len(img_list), desc="Processing images"):
+
+                prompt = f"{class_item}_{img_path.split('/')[-1][:3]}"
+                results[(model_name, prompt)] = journal.record(model_name, prompt, avg_score, inputs)
+
+    journal.close()
+    return results
+
+def write_results(args, manifest, results):
+    import pandas as pd
+    diversity_score_csv = f"results/diversity_score_{args.mode}_{formatted_time}.csv"
+    diversity_prompt_score_csv = f"results/diversity_prompt_score_{args.mode}_{formatted_time}.csv"
+    os.makedirs(os.path.dirname(diversity_score_csv), exist_ok=True)
+
+    column_items = args.class_items.copy().append("total average")
+    score_csv = pd.DataFrame(index=args.model_names, columns=column_items)
+    score_of_prompt_csv = pd.DataFrame(columns=args.model_names)
+
+    for model_name in args.model_names:
+
+        for class_item in args.class_items:
+
             diversity_score = []
-            
-            for idx, img_path in tqdm(enumerate(img_list), total=len(img_list), desc="Processing images"):
-                
-                split_img_list = split_mxn_grid(img_path, img_grid, cache_dir)
-                if len(split_img_list) <= 1:
+
+            # prompts in the order of the sorted image listing
+            prompts = sorted(prompt for result_model, prompt in results if result_model == model_name and prompt.rsplit('_', 1)[0] == class_item)
+            for prompt in prompts:
+                avg_score = results[(model_name, prompt)]
+
+                if avg_score is None:
                     continue
                 
-                score = []
-                
-                for i in range(len(split_img_list)):
-                    for j in range(i+1, len(split_img_list)):
-                        prob = img_similar_score(split_img_list[i], split_img_list[j])
-                        score.append(prob)
-                
-                avg_score = sum(score)/len(score)
-                
                 diversity_score.append(avg_score)
-                model_score.append(avg_score)
                 
-                score_of_prompt_csv.loc[f"{class_item}_{img_path.split('/')[-1][:3]}", model_name] = avg_score
+                score_of_prompt_csv.loc[prompt, model_name] = avg_score
 
             if len(diversity_score) != 0:
                 score_csv.loc[model_name, class_item] = sum(diversity_score)/len(diversity_score)
@@ -92,8 +116,11 @@ def main():
     score_of_prompt_csv = score_of_prompt_csv.sort_index()
     save2csv(score_of_prompt_csv, diversity_prompt_score_csv)
 
-    if os.path.exists(cache_dir):
-        shutil.rmtree(cache_dir, onerror=on_rm_error)
+def main():
+    args = parse_args()
+    manifest = load_manifest(args.mode, args.manifest)
+    run_metric(args, "diversity", manifest, score, write_results)
+
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -1,39 +1,40 @@
 from PIL import Image
 Image.MAX_IMAGE_PIXELS = None
 import os
-import megfile
-import shutil
-import pandas as pd
 from tqdm import tqdm
-from scripts.utils.utils import parse_args, split_mxn_grid, save2csv, on_rm_error
+from scripts.utils.tile_cache import build_tile_cache
+from scripts.utils.loader import journaled_loader, tile_loader
+from scripts.utils.pipeline import Pipeline, Stage
+from scripts.utils.utils import parse_args, save2csv
+from scripts.utils.manifest import load_manifest
+from scripts.utils.journal import build_journal
+from scripts.utils.parallel import run_metric
 
-import json
-from scripts.utils.inference import LLM2CLIP
+from scripts.utils.backends import build_backend
 
 import datetime
 current_time = datetime.datetime.now()
 formatted_time = current_time.strftime("%Y-%m-%d_%H-%M-%S")
 
-def main():
-    args = parse_args()
-    cache_dir = f"tmp_{formatted_time}"
-    os.makedirs(cache_dir, exist_ok=True)
-    
-    LLM2CLIP_Model = LLM2CLIP()
-    
-    if args.mode == "EN":
-        answer_json_dir = "scripts/reasoning/gt_answer.json"
-    else:
-        answer_json_dir = "scripts/reasoning/gt_answer_zh.json"
-    with open(answer_json_dir, 'r', encoding='utf-8') as f:
-        answer_gt = json.load(f)
-        
-    reasoning_score_csv = f"results/reasoning_score_{args.mode}_{formatted_time}.csv"
-    reasoning_prompt_score_csv = f"results/reasoning_prompt_score_{args.mode}_{formatted_time}.csv"
-    os.makedirs(os.path.dirname(reasoning_score_csv), exist_ok=True)
+def reasoning_prompt_score(LLM2CLIP_Model, split_img_list, answer_text):
+    score = LLM2CLIP_Model.text_img_similarity_score(split_img_list, answer_text)
+
+    if len(score) != 0:
+        score = [x for x in score if x is not None]
+        return sum(score)/len(score)
+    return None
+
+def score(args, manifest, sharding):
+    import megfile
+    LLM2CLIP_Model = build_backend(args, "text_image")
+    tile_cache = build_tile_cache(args)
     
-    score_csv = pd.DataFrame(index=args.model_names, columns=["reasoning"])
-    score_of_prompt_csv = pd.DataFrame(columns=args.model_names)
+    journal = build_journal(args, "reasoning", tile_cache)
+    load = journaled_loader(journal, tile_loader(args, tile_cache, LLM2CLIP_Model.input_size))
+    answer_gt = {id: item["answer"] for id, item in manifest.prompts("reasoning", "answer").items()}
+
+    # similarity of each prompt to its answer, keyed by (model_name, id)
+    results = {}
 
     for model_id, model_name in enumerate(args.model_names):
         
@@ -43,24 +44,46 @@ def main():
         
         image_dir = args.image_dirname + '/' + model_name
         img_list = megfile.smart_glob(image_dir + '/*')
-        img_list = sorted(img_list)
+        img_list = sorted(img_path for img_path in img_list if sharding.owns("reasoning", img_path.split('/')[-1][:3]))
         
         print(f"We fetch {len(img_list)} images.")
         
-        for idx, img_path in tqdm(enumerate(img_list), total=len(img_list), desc="Processing images"):
+        def load_reasoning_tiles(img_path):
+            return load(model_name, img_path.split('/')[-1][:3], img_path, img_grid)
+
+        def score_reasoning_tiles(img_path, loaded):
+            # finished prompts come without tiles
+            inputs, split_img_list = loaded
+            if split_img_list is None:
+                return inputs, None
+            return inputs, reasoning_prompt_score(LLM2CLIP_Model, split_img_list, answer_gt[img_path.split('/')[-1][:3]])
+
+        pipeline = Pipeline(f"reasoning {model_name}", [
+            Stage("load", load_reasoning_tiles, "io", args.num_io_workers),
+            Stage("similarity", score_reasoning_tiles, "model"),
+        ], args.prefetch)
+
+        for img_path, (inputs, score) in tqdm(pipeline.run(img_list), total=len(img_list), desc="Processing images"):
             
-            split_img_list = split_mxn_grid(img_path, img_grid, cache_dir)
             
             img_id = img_path.split('/')[-1][:3]
-            answer_text = answer_gt[img_id]
+            results[(model_name, img_id)] = journal.record(model_name, img_id, score, inputs)
 
-            score = LLM2CLIP_Model.text_img_similarity_score(split_img_list, answer_text)
+    journal.close()
+    return results
 
-            if len(score) != 0:
-                score = [x for x in score if x is not None]
-                score_of_prompt_csv.loc[img_id, model_name] = sum(score)/len(score)
-            else:
-                score_of_prompt_csv.loc[img_id, model_name] = None
+def write_results(args, manifest, results):
+    import pandas as pd
+    reasoning_score_csv = f"results/reasoning_score_{args.mode}_{formatted_time}.csv"
+    reasoning_prompt_score_csv = f"results/reasoning_prompt_score_{args.mode}_{formatted_time}.csv"
+    os.makedirs(os.path.dirname(reasoning_score_csv), exist_ok=True)
+    
+    score_csv = pd.DataFrame(index=args.model_names, columns=["reasoning"])
+    score_of_prompt_csv = pd.DataFrame(columns=args.model_names)
+
+    for model_name in args.model_names:
+        for img_id in sorted(prompt for result_model, prompt in results if result_model == model_name):
+            score_of_prompt_csv.loc[img_id, model_name] = results[(model_name, img_id)]
     
     mean_values = score_of_prompt_csv.mean()
     score_csv["reasoning"] = mean_values.values
@@ -69,8 +92,11 @@ def main():
     score_of_prompt_csv = score_of_prompt_csv.sort_index()
     save2csv(score_of_prompt_csv, reasoning_prompt_score_csv)
 
-    if os.path.exists(cache_dir):
-        shutil.rmtree(cache_dir, onerror=on_rm_error)
+def main():
+    args = parse_args()
+    manifest = load_manifest(args.mode, args.manifest)
+    run_metric(args, "reasoning", manifest, score, write_results)
+
 
 if __name__ == "__main__":
     main()
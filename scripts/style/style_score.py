@@ -1,15 +1,17 @@
 from PIL import Image
 Image.MAX_IMAGE_PIXELS = None
 import os
-import megfile
-import shutil
-import pandas as pd
 from tqdm import tqdm
-from scripts.utils.utils import parse_args, split_mxn_grid, save2csv, on_rm_error
+from scripts.utils.tile_cache import build_tile_cache
+from scripts.utils.loader import journaled_loader, tile_loader
+from scripts.utils.pipeline import Pipeline, Stage
+from scripts.utils.utils import parse_args, save2csv
+from scripts.utils.manifest import load_manifest
+from scripts.utils.journal import build_journal
+from scripts.utils.parallel import run_metric
 
-import torch
-torch.cuda.empty_cache()
-from scripts.utils.inference import CSDStyleEmbedding, SEStyleEmbedding
+from scripts.utils.backends import backend_class, build_backend
+from scripts.utils.workers import PreprocessPool, receive_tensors
 
 import datetime
 current_time = datetime.datetime.now()
@@ -17,30 +19,69 @@ formatted_time = current_time.strftime("%Y-%m-%d_%H-%M-%S")
 
 style_list = ['abstract_expressionism', 'art_nouveau', 'baroque', 'chinese_ink_painting', 'cubism', 'fauvism', 'impressionism', 'line_art', 'minimalism', 'pointillism', 'pop_art', 'rococo',  'ukiyo-e', 'clay', 'crayon',  'graffiti','lego', 'comic', 'pencil_sketch', 'stone_sculpture', 'watercolor', 'celluloid', 'chibi',   'cyberpunk',  'ghibli',  'impasto', 'pixar', 'pixel_art',  '3d_rendering']
 
-def main():
-    args = parse_args()
-    cache_dir = f"tmp_{formatted_time}"
-    os.makedirs(cache_dir, exist_ok=True)
+def embed_tiles(CSD_Encoder, SE_Encoder, tiles):
+    # the preprocess pool hands over ready pixel values instead of tiles
+    if isinstance(tiles, dict):
+        if len(tiles) == 0:
+            return None, None
+        pixel_values = receive_tensors(tiles, CSD_Encoder.device)
+        return CSD_Encoder.embed_pixels(pixel_values["CSD"]), SE_Encoder.embed_pixels(pixel_values["SE"])
+
+    if len(tiles) == 0:
+        return None, None
+    return CSD_Encoder.get_style_embeddings(tiles), SE_Encoder.get_style_embeddings(tiles)
+
+def style_prompt_score(CSD_Encoder, SE_Encoder, split_img_list, CSD_ref_embeds, SE_ref_embeds):
+    score = []
+    CSD_embeds, SE_embeds = embed_tiles(CSD_Encoder, SE_Encoder, split_img_list)
+    if CSD_embeds is not None:
+        CSD_tile_scores = (CSD_embeds @ CSD_ref_embeds.T).max(dim=1).values.tolist()
+        SE_tile_scores = (SE_embeds @ SE_ref_embeds.T).max(dim=1).values.tolist()
+
+        for CSD_max_style_score, SE_max_style_score in zip(CSD_tile_scores, SE_tile_scores):
+            max_style_score = (max(CSD_max_style_score, 0) + max(SE_max_style_score, 0)) / 2
+            score.append(max_style_score)
+
+    if len(score) != 0:
+        return sum(score)/len(score)
+    return None
 
-    style_csv_path = "scripts/style/style.csv"
-    df = pd.read_csv(style_csv_path, dtype=str)
+def score(args, manifest, sharding):
+    import torch
+    import megfile
+    tile_cache = build_tile_cache(args)
+    journal = build_journal(args, "style", tile_cache)
+    # style of each prompt id, None for prompts without one
+    styles = {id: item.get("style") for id, item in manifest.prompts("anime").items()}
     
-    CSD_Encoder = CSDStyleEmbedding(model_path="scripts/style/models/checkpoint.pth")
-    SE_Encoder = SEStyleEmbedding(pretrained_path="xingpng/OneIG-StyleEncoder")
+    CSD_Encoder = build_backend(args, "csd", model_path="scripts/style/models/checkpoint.pth")
+    SE_Encoder = build_backend(args, "se", pretrained_path="xingpng/OneIG-StyleEncoder")
+    min_tile_side = max(CSD_Encoder.input_size, SE_Encoder.input_size)
+    if args.num_preprocess_workers > 0:
+        preprocess_pool = PreprocessPool(
+            args,
+            {"CSD": backend_class(args.backend, "csd").build_preprocess, "SE": backend_class(args.backend, "se").build_preprocess},
+            args.num_preprocess_workers,
+            min_tile_side,
+        )
+        load_tiles = preprocess_pool.load
+        # the loading threads only wait for the preprocess processes
+        load_kind = "cpu"
+        num_load_workers = max(args.num_io_workers, args.num_preprocess_workers)
+    else:
+        preprocess_pool = None
+        load_tiles = tile_loader(args, tile_cache, min_tile_side)
+        load_kind = "io"
+        num_load_workers = args.num_io_workers
+    load = journaled_loader(journal, load_tiles)
 
     CSD_embed_pt = "scripts/style/CSD_embed.pt"
-    CSD_ref = torch.load(CSD_embed_pt, weights_only=False)
+    CSD_ref = torch.load(CSD_embed_pt, weights_only=False, map_location=CSD_Encoder.device)
     SE_embed_pt = "scripts/style/SE_embed.pt"
-    SE_ref = torch.load(SE_embed_pt)
-
-    style_score_csv = f"results/style_score_{args.mode}_{formatted_time}.csv"
-    style_style_score_csv = f"results/style_style_score_{args.mode}_{formatted_time}.csv"
-    style_prompt_score_csv = f"results/style_prompt_score_{args.mode}_{formatted_time}.csv"
-    os.makedirs(os.path.dirname(style_score_csv), exist_ok=True)
+    SE_ref = torch.load(SE_embed_pt, map_location=SE_Encoder.device)
 
-    score_csv = pd.DataFrame(index=args.model_names, columns=["style"])
-    score_of_style_csv = pd.DataFrame(index=args.model_names, columns=style_list)
-    score_of_prompt_csv = pd.DataFrame(columns=args.model_names)  
+    # style score of each prompt, keyed by (model_name, id)
+    results = {}
     
     for model_id, model_name in enumerate(args.model_names):
         
@@ -50,44 +91,68 @@ def main():
         
         image_dir = args.image_dirname + '/' + model_name
         img_list = megfile.smart_glob(image_dir + '/*')
-        img_list = sorted(img_list)
+        img_list = sorted(img_path for img_path in img_list if sharding.owns("anime", img_path.split('/')[-1][:3]))
         
         print(f"We fetch {len(img_list)} images.")
-        
-        style_dict = {style: [] for style in style_list}
 
-        for idx, img_path in tqdm(enumerate(img_list), total=len(img_list), desc="Processing images"):
+        def load_style_tiles(img_path):
+            id = img_path.split('/')[-1][:3]
+            # prompts without a style are skipped below, so there is no need to fetch them
+            if styles.get(id) is None:
+                return None, None
+            return load(model_name, id, img_path, img_grid)
+
+        def score_style_tiles(img_path, loaded):
+            # finished prompts and prompts without a style come without tiles
+            inputs, split_img_list = loaded
+            if split_img_list is None:
+                return inputs, None
+            image_style = styles[img_path.split('/')[-1][:3]]
+            return inputs, style_prompt_score(CSD_Encoder, SE_Encoder, split_img_list, CSD_ref[image_style], SE_ref[image_style])
+
+        pipeline = Pipeline(f"style {model_name}", [
+            Stage("load", load_style_tiles, load_kind, num_load_workers),
+            Stage("embed", score_style_tiles, "model"),
+        ], max(args.prefetch, num_load_workers))
+
+        for img_path, (inputs, score) in tqdm(pipeline.run(img_list), total=len(img_list), desc="Processing images"):
             
             id = img_path.split('/')[-1][:3]
             
-            image_style =  str(df.loc[df["id"] == id, "class"].values[0])
-            if (image_style[:3] == "nan"):
+            image_style = styles.get(id)
+            if image_style is None:
                 continue
-            else:
-                image_style = image_style.lower().replace(' ', '_')
-            
-            split_img_list = split_mxn_grid(img_path, img_grid, cache_dir)
 
-            CSD_ref_embeds = CSD_ref[image_style]
-            SE_ref_embeds = SE_ref[image_style]
-            
-            score = []
-            for num, split_img_path in enumerate(split_img_list):
-                
-                CSD_embed = CSD_Encoder.get_style_embedding(split_img_path)
-                SE_embed = SE_Encoder.get_style_embedding(split_img_path)
-                
-                CSD_max_style_score = max(torch.max(CSD_embed @ CSD_ref_embeds.T).item(), 0)
-                SE_max_style_score = max(torch.max(SE_embed @ SE_ref_embeds.T).item(), 0)
-                
-                max_style_score = (CSD_max_style_score + SE_max_style_score) / 2
-                score.append(max_style_score)
-            
-            if len(score) != 0:
-                score_of_prompt_csv.loc[id, model_name] = sum(score)/len(score)
-                style_dict[image_style].append(sum(score)/len(score))
-            else:
-                score_of_prompt_csv.loc[id, model_name] = None        
+            results[(model_name, id)] = journal.record(model_name, id, score, inputs)
+
+    if preprocess_pool is not None:
+        preprocess_pool.close()
+    journal.close()
+    return results
+
+def write_results(args, manifest, results):
+    import pandas as pd
+    styles = {id: item.get("style") for id, item in manifest.prompts("anime").items()}
+
+    style_score_csv = f"results/style_score_{args.mode}_{formatted_time}.csv"
+    style_style_score_csv = f"results/style_style_score_{args.mode}_{formatted_time}.csv"
+    style_prompt_score_csv = f"results/style_prompt_score_{args.mode}_{formatted_time}.csv"
+    os.makedirs(os.path.dirname(style_score_csv), exist_ok=True)
+
+    score_csv = pd.DataFrame(index=args.model_names, columns=["style"])
+    score_of_style_csv = pd.DataFrame(index=args.model_names, columns=style_list)
+    score_of_prompt_csv = pd.DataFrame(columns=args.model_names)  
+    
+    for model_name in args.model_names:
+        
+        style_dict = {style: [] for style in style_list}
+
+        for id in sorted(prompt for result_model, prompt in results if result_model == model_name):
+            score = results[(model_name, id)]
+
+            score_of_prompt_csv.loc[id, model_name] = score
+            if score is not None:
+                style_dict[styles[id]].append(score)
                     
         for style in style_list:
             if len(style_dict[style]) != 0:
@@ -102,8 +167,11 @@ def main():
     score_of_prompt_csv = score_of_prompt_csv.sort_index()
     save2csv(score_of_prompt_csv, style_prompt_score_csv)    
 
-    if os.path.exists(cache_dir):
-        shutil.rmtree(cache_dir, onerror=on_rm_error)
+def main():
+    args = parse_args()
+    manifest = load_manifest(args.mode, args.manifest)
+    run_metric(args, "style", manifest, score, write_results)
+
 
 if __name__ == "__main__":
     main()
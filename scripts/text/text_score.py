@@ -1,33 +1,127 @@
 from PIL import Image
 Image.MAX_IMAGE_PIXELS = None
 import os
-import megfile
-import shutil
-import pandas as pd
 from tqdm import tqdm
-from scripts.utils.utils import parse_args, split_mxn_grid, save2csv, on_rm_error
+from scripts.utils.tile_cache import build_tile_cache
+from scripts.utils.loader import journaled_loader, tile_loader
+from scripts.utils.pipeline import Pipeline, Stage
+from scripts.utils.image_index import build_image_index
+from scripts.utils.manifest import load_manifest
+from scripts.utils.journal import build_journal
+from scripts.utils.parallel import run_metric
+from scripts.utils.utils import parse_args, save2csv
 
 from scripts.text.text_utils import preprocess_string, clean_and_remove_hallucinations, levenshtein_distance, calculate_char_match_ratio
-from scripts.utils.inference import Qwen2_5VLBatchInferencer
+from scripts.utils.backends import build_backend
 
 import datetime
 current_time = datetime.datetime.now()
 formatted_time = current_time.strftime("%Y-%m-%d_%H-%M-%S")
 
-def main():
-    args = parse_args()
-    cache_dir = f"tmp_{formatted_time}"
-    os.makedirs(cache_dir, exist_ok=True)
+def ocr_prompt_scores(influencer, prompts):
+    # (ED, CR, matched words, WAC, GT words) of each tile of each (split_img_list, text_gt), None when
+    # the prompt has no usable image. The tiles of all prompts that generate as many tokens are read
+    # in one call, so the token budget batcher can fill its batches across prompts.
+    requests = {}
+    for idx, (split_img_list, text_gt) in enumerate(prompts):
+        if not split_img_list:
+            continue
+
+        word_count = len(text_gt.split())
+        if (word_count > 60):
+            max_new_tokens = 256
+        else:
+            max_new_tokens = 128
+        requests.setdefault(max_new_tokens, []).append(idx)
+
+    ocr_results = {}
+    for max_new_tokens, indices in requests.items():
+        outputs = influencer.infer_ocr([tile for idx in indices for tile in prompts[idx][0]], max_new_tokens)
+        start = 0
+        for idx in indices:
+            ocr_results[idx] = outputs[start:start + len(prompts[idx][0])]
+            start += len(prompts[idx][0])
+
+    return [ocr_tile_scores(ocr_results[idx], text_gt) if idx in ocr_results else None for idx, (_, text_gt) in enumerate(prompts)]
+
+def ocr_tile_scores(ocr_results, text_gt):
+    text_gt_preprocessed = preprocess_string(text_gt)
+    text_ocr_list = clean_and_remove_hallucinations(ocr_results)
+
+    tile_scores = []
+    for text_ocr in text_ocr_list:
+        text_ocr_preprocessed = preprocess_string(text_ocr)
+
+        edit_distance = levenshtein_distance(text_ocr_preprocessed, text_gt_preprocessed)
+
+        completion_ratio = 1 if edit_distance == 0 else 0
+
+        match_word_count, text_word_accuracy, gt_word_count = calculate_char_match_ratio(text_gt_preprocessed, text_ocr_preprocessed)
+
+        tile_scores.append([float(edit_distance), completion_ratio, match_word_count, text_word_accuracy, gt_word_count])
+    return tile_scores
+
+def score(args, manifest, sharding):
+    tile_cache = build_tile_cache(args)
     
-    influencer = Qwen2_5VLBatchInferencer("Qwen/Qwen2.5-VL-7B-Instruct")
+    influencer = build_backend(args, "vlm", model_path="Qwen/Qwen2.5-VL-7B-Instruct", chat_templates=manifest.chat_templates)
+    journal = build_journal(args, "text", tile_cache, influencer.model_id)
+    load = journaled_loader(journal, tile_loader(args, tile_cache))
     
+    text_content = {id: item["text_content"] for id, item in manifest.prompts("text", "text_content").items() if sharding.owns("text", id)}
+
+    image_index = build_image_index(
+        {model_name: args.image_dirname + '/' + model_name for model_name in args.model_names},
+        text_content.keys(),
+    )
+
+    # OCR scores of the tiles of each prompt, keyed by (model_name, id)
+    results = {}
+
+    for model_id, model_name in enumerate(args.model_names):
+        
+        print(f"It is {model_name} time.")
+        
+        img_grid = (int(args.image_grid[model_id].split(',')[0]), int(args.image_grid[model_id].split(',')[-1])) 
+        
+        def text_image(id):
+            img_path = image_index[model_name].get(id, [])
+            return img_path[0] if len(img_path) == 1 else None
+
+        # with a token budget, one work item is a group of prompts whose tiles are read together
+        group_size = args.ocr_batch_prompts if args.token_budget is not None else 1
+        items = list(text_content.items())
+        groups = [items[start:start + group_size] for start in range(0, len(items), group_size)]
+
+        def load_text_tiles(group):
+            return [load(model_name, id, text_image(id), img_grid) for id, _ in group]
+
+        def ocr_text_tiles(group, loaded):
+            # finished prompts come without tiles and are not read again
+            tile_scores = ocr_prompt_scores(influencer, [(split_img_list, text_gt) for (_, split_img_list), (_, text_gt) in zip(loaded, group)])
+            return [(inputs, scores) for (inputs, _), scores in zip(loaded, tile_scores)]
+
+        pipeline = Pipeline(f"text {model_name}", [
+            Stage("load", load_text_tiles, "io", args.num_io_workers),
+            Stage("ocr", ocr_text_tiles, "model"),
+        ], args.prefetch)
+
+        with tqdm(total=len(text_content), desc="Processing text") as progress:
+            for group, outputs in pipeline.run(groups):
+                for (id, _), (inputs, tile_scores) in zip(group, outputs):
+                    results[(model_name, id)] = journal.record(model_name, id, tile_scores, inputs)
+                progress.update(len(group))
+
+    journal.close()
+    influencer.close()
+    return results
+
+def write_results(args, manifest, results):
+    import pandas as pd
     if args.mode == "EN":
-        text_csv_path = "scripts/text/text_content.csv"
         MAX_EDIT_DISTANCE = 100
     else:
-        text_csv_path = "scripts/text/text_content_zh.csv"
         MAX_EDIT_DISTANCE = 50
-    text_df = pd.read_csv(text_csv_path, dtype=str)
 
     text_score_csv = f"results/text_score_{args.mode}_{formatted_time}.csv"
     text_prompt_score_csv = f"results/text_prompt_score_{args.mode}_{formatted_time}.csv"
@@ -36,61 +130,35 @@ def main():
     score_csv = pd.DataFrame(index=args.model_names, columns=["ED", "CR", "WAC", "text score"])
     score_of_prompt_csv = pd.DataFrame(columns=args.model_names)
 
-    for model_id, model_name in enumerate(args.model_names):
-        
-        print(f"It is {model_name} time.")
-        
-        img_grid = (int(args.image_grid[model_id].split(',')[0]), int(args.image_grid[model_id].split(',')[-1])) 
+    for model_name in args.model_names:
         
         edit_distances = []
         completion_ratios = []
         match_word_counts = []
         gt_word_counts = []
-        
-        for id, text_gt in tqdm(zip(text_df["id"], text_df["text_content"]), total=len(text_df), desc="Processing text"):
-            word_count = len(text_gt.split())
-            if (word_count > 60):
-                max_new_tokens = 256
-            else:
-                max_new_tokens = 128
-                
-            text_gt_preprocessed = preprocess_string(text_gt)
-            
-            img_path = megfile.smart_glob(args.image_dirname + '/' + model_name + '/' +  id + '*')
-            if len(img_path) != 1:
+
+        for id in manifest.prompts("text", "text_content"):
+            tile_scores = results[(model_name, id)]
+
+            if tile_scores is None:
                 score_of_prompt_csv.loc[id, model_name] = None
-            else:
-                split_img_list = split_mxn_grid(img_path[0], img_grid, cache_dir)    
-                if  len(split_img_list) != 0:                 
-                    ocr_results = influencer.infer_ocr(split_img_list, max_new_tokens)
-                else:
-                    score_of_prompt_csv.loc[id, model_name] = None
-                
-                text_ocr_list = clean_and_remove_hallucinations(ocr_results)
-                
-                ED_score = []
-                CR_score = []
-                WAC_score = []
-                
-                for text_ocr in text_ocr_list:
-                    text_ocr_preprocessed = preprocess_string(text_ocr)
-                    
-                    edit_distance = levenshtein_distance(text_ocr_preprocessed, text_gt_preprocessed)
-                    
-                    completion_ratio = 1 if edit_distance == 0 else 0
-                    
-                    match_word_count, text_word_accuracy, gt_word_count = calculate_char_match_ratio(text_gt_preprocessed, text_ocr_preprocessed)
-                    
-                    edit_distances.append(edit_distance)
-                    completion_ratios.append(completion_ratio)
-                    match_word_counts.append(match_word_count)
-                    gt_word_counts.append(gt_word_count)
-
-                    ED_score.append(edit_distance)
-                    CR_score.append(completion_ratio)
-                    WAC_score.append(text_word_accuracy)
-
-                score_of_prompt_csv.loc[id, model_name] = [(sum(ED_score)/len(ED_score)).item(), sum(CR_score)/len(CR_score), sum(WAC_score)/len(WAC_score)]
+                continue
+
+            ED_score = []
+            CR_score = []
+            WAC_score = []
+
+            for edit_distance, completion_ratio, match_word_count, text_word_accuracy, gt_word_count in tile_scores:
+                edit_distances.append(edit_distance)
+                completion_ratios.append(completion_ratio)
+                match_word_counts.append(match_word_count)
+                gt_word_counts.append(gt_word_count)
+
+                ED_score.append(edit_distance)
+                CR_score.append(completion_ratio)
+                WAC_score.append(text_word_accuracy)
+
+            score_of_prompt_csv.loc[id, model_name] = [sum(ED_score)/len(ED_score), sum(CR_score)/len(CR_score), sum(WAC_score)/len(WAC_score)]
 
         ED = sum(edit_distances) / len(edit_distances)
         CR = sum(completion_ratios) / len(completion_ratios)
@@ -105,8 +173,11 @@ def main():
 
     save2csv(score_of_prompt_csv, text_prompt_score_csv)
 
-    if os.path.exists(cache_dir):
-        shutil.rmtree(cache_dir, onerror=on_rm_error)
+def main():
+    args = parse_args()
+    manifest = load_manifest(args.mode, args.manifest)
+    run_metric(args, "text", manifest, score, write_results)
+
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,97 @@
+import json
+import time
+import hashlib
+import sqlite3
+import weakref
+import threading
+import numpy as np
+from PIL import Image
+
+
+class AnswerCache:
+    def __init__(self, path: str, max_entries: int = 2_000_000):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        # digests of live tiles by id, each tile is hashed once for all the questions about it
+        self.digests = {}
+        # opened when the backend is built but used by the pipeline's model thread, every access goes through the lock
+        self.lock = threading.RLock()
+        self.index = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self.index.execute("PRAGMA journal_mode=WAL")
+        self.index.execute("CREATE TABLE IF NOT EXISTS answers (key TEXT PRIMARY KEY, value TEXT, last_access REAL)")
+        self.index.execute("CREATE INDEX IF NOT EXISTS answers_last_access ON answers (last_access)")
+        self.index.commit()
+        # entries in the table, counted once here and then by the inserts so a batch does not scan the table
+        self.count = self.index.execute("SELECT COUNT(*) FROM answers").fetchone()[0]
+
+    def image_digest(self, image):
+        import megfile
+        if not isinstance(image, Image.Image):
+            with megfile.smart_open(image, 'rb') as f:
+                return hashlib.sha1(f.read()).hexdigest()
+        if id(image) not in self.digests:
+            digest = hashlib.sha1(f"{image.mode}{image.size}".encode())
+            digest.update(np.asarray(image).tobytes())
+            self.digests[id(image)] = digest.hexdigest()
+            weakref.finalize(image, self.digests.pop, id(image), None)
+        return self.digests[id(image)]
+
+    def key(self, model_id, params, text, image):
+        return hashlib.sha1(json.dumps([model_id, params, text, self.image_digest(image)]).encode()).hexdigest()
+
+    def get_many(self, keys):
+        values = {}
+        with self.lock:
+            for start in range(0, len(keys), 500):
+                chunk = keys[start:start + 500]
+                rows = self.index.execute(
+                    f"SELECT key, value FROM answers WHERE key IN ({','.join('?' * len(chunk))})", chunk
+                ).fetchall()
+                values.update(rows)
+
+            found = [key for key in keys if key in values]
+            self.hits += len(found)
+            self.misses += len(keys) - len(found)
+            if found:
+                with self.index:
+                    self.index.executemany("UPDATE answers SET last_access = ? WHERE key = ?", [(time.time(), key) for key in found])
+        # yes/no outputs are (answer, probability) pairs, JSON turns them into lists
+        return [self._decode(values[key]) if key in values else None for key in keys]
+
+    @staticmethod
+    def _decode(value):
+        value = json.loads(value)
+        return tuple(value) if isinstance(value, list) else value
+
+    def put_many(self, items):
+        now = time.time()
+        with self.lock, self.index:
+            self.index.executemany(
+                "INSERT OR REPLACE INTO answers VALUES (?, ?, ?)",
+                [(key, json.dumps(value, ensure_ascii=False), now) for key, value in items],
+            )
+            # replaced keys and answers written by other processes make the running count drift,
+            # so it is only trusted to decide when to count exactly
+            self.count += len(items)
+            if self.count <= self.max_entries:
+                return
+            self.count = self.index.execute("SELECT COUNT(*) FROM answers").fetchone()[0]
+            if self.count > self.max_entries:
+                # evicting down to 90% of the limit leaves room for many batches before the next count
+                target = self.max_entries - self.max_entries // 10
+                self.index.execute(
+                    "DELETE FROM answers WHERE key IN (SELECT key FROM answers ORDER BY last_access LIMIT ?)",
+                    (self.count - target,),
+                )
+                self.count = target
+
+    def stats(self):
+        requests = self.hits + self.misses
+        hit_rate = self.hits / requests if requests else 0.0
+        return f"VLM answer cache: {self.hits} hits, {self.misses} misses, {hit_rate:.1%} hit rate."
+
+    def close(self):
+        print(self.stats())
+        with self.lock:
+            self.index.close()
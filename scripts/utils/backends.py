@@ -0,0 +1,257 @@
+import gc
+import sys
+import math
+import importlib
+from scripts.utils.utils import open_image
+from scripts.utils.answer_cache import AnswerCache
+from scripts.utils.batching import TokenBudgetBatcher
+
+# module and class of each role, imported only when a backend is built
+BACKENDS = {
+    "hf": ("scripts.utils.inference", {
+        "vlm": "Qwen2_5VLBatchInferencer",
+        "csd": "CSDStyleEmbedding",
+        "se": "SEStyleEmbedding",
+        "text_image": "LLM2CLIP",
+        "image_distance": "DreamSimDistance",
+    }),
+    "mock": ("scripts.utils.mock_backend", {
+        "vlm": "MockVLM",
+        "csd": "MockCSDStyleEmbedding",
+        "se": "MockSEStyleEmbedding",
+        "text_image": "MockTextImage",
+        "image_distance": "MockImageDistance",
+    }),
+}
+
+
+def backend_class(backend, role):
+    module_name, classes = BACKENDS[backend]
+    return getattr(importlib.import_module(module_name), classes[role])
+
+
+# backends already built by (backend, role, device, arguments), kept only in a resident process
+resident_backends = None
+
+
+def keep_backends_resident():
+    global resident_backends
+    if resident_backends is None:
+        resident_backends = {}
+    return resident_backends
+
+
+def release_backends(roles):
+    # drops the resident backends of these roles, their memory is freed once no scorer holds them
+    if resident_backends is None:
+        return
+    for key in [key for key in resident_backends if key[1] in roles]:
+        del resident_backends[key]
+    gc.collect()
+    torch = sys.modules.get("torch")
+    if torch is not None and torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
+
+def build_backend(args, role, **kwargs):
+    # chat templates depend on the manifest of the job, a resident VLM collects those of every job
+    chat_templates = kwargs.pop("chat_templates", None)
+    key = (args.backend, role, args.device, tuple(sorted(kwargs.items())))
+    backend = None if resident_backends is None else resident_backends.get(key)
+    if backend is None:
+        backend = backend_class(args.backend, role)(device=args.device, **kwargs)
+        if resident_backends is not None:
+            resident_backends[key] = backend
+    if chat_templates:
+        backend.chat_templates.update(chat_templates)
+    if role == "vlm":
+        backend.batcher = TokenBudgetBatcher(args.token_budget)
+        if args.answer_cache:
+            backend.answer_cache = AnswerCache(args.answer_cache, args.answer_cache_size)
+    return backend
+
+
+class VLMBackend:
+    # answers semantic questions and reads text on single images
+    TEXT_PROMPT = (
+        "Recognize the text in the image, only reply with the text content, "
+        "but avoid repeating previously mentioned content. "
+        "If no text is recognized, please reply with 'No text recognized'."
+    )
+
+    def __init__(self, model_id: str, chat_templates: dict = None):
+        # model_id tells apart the answers of different checkpoints in the answer cache
+        self.model_id = model_id
+        # rendered chat templates keyed by the text of the message, pre-filled from the manifest
+        self.chat_templates = dict(chat_templates or {})
+        self.answer_cache = None
+        self.batcher = None
+
+    def generate(self, messages, max_new_tokens=128):
+        raise NotImplementedError
+
+    def yes_no(self, messages):
+        # (answer, probability of "Yes") of each message
+        raise NotImplementedError
+
+    def encode_image(self, image):
+        raise NotImplementedError
+
+    def batch_yes_no_with_features(self, messages, image_features):
+        raise NotImplementedError
+
+    def prompt_tokens(self, msg):
+        # rough prompt length, one token per 28x28 image patch as in Qwen2.5-VL, only used to batch
+        # requests of similar length together
+        width, height = open_image(self.message_image(msg)).size
+        return math.ceil(width * height / 28 ** 2) + len(self.message_text(msg).encode("utf-8")) // 4 + 32
+
+    def batch_inference(self, messages, max_new_tokens=128):
+        return self._cached(messages, f"generate:{max_new_tokens}", lambda misses: self.generate(misses, max_new_tokens), max_new_tokens)
+
+    def batch_yes_no(self, messages):
+        return self._cached(messages, "yes_no", self.yes_no, 1)
+
+    def call_size(self, num_requests, batch_size):
+        # with a token budget the batcher sees all requests of a call and forms the batches itself
+        if self.batcher is not None and self.batcher.token_budget is not None:
+            return max(num_requests, 1)
+        return batch_size
+
+    def _cached(self, messages, params, run, new_tokens):
+        # only the messages missing from the answer cache go to the model
+        if self.answer_cache is None:
+            return self._batched(messages, run, new_tokens)
+        keys = [self.answer_cache.key(self.model_id, params, self.message_text(msg), self.message_image(msg)) for msg in messages]
+        outputs = self.answer_cache.get_many(keys)
+        misses = [idx for idx, output in enumerate(outputs) if output is None]
+        if misses:
+            for idx, output in zip(misses, self._batched([messages[idx] for idx in misses], run, new_tokens)):
+                outputs[idx] = output
+            self.answer_cache.put_many([(keys[idx], outputs[idx]) for idx in misses])
+        return outputs
+
+    def _batched(self, messages, run, new_tokens):
+        if self.batcher is None:
+            return run(messages)
+        return self.batcher.run(messages, [self.prompt_tokens(msg) for msg in messages], new_tokens, run)
+
+    def close(self):
+        if self.batcher is not None:
+            if self.batcher.requests:
+                print(self.batcher.stats())
+            self.batcher = None
+        if self.answer_cache is not None:
+            self.answer_cache.close()
+            self.answer_cache = None
+
+    @staticmethod
+    def message_text(msg):
+        return "\n".join(item["text"] for turn in msg for item in turn["content"] if item["type"] == "text")
+
+    @staticmethod
+    def message_image(msg):
+        return next(item["image"] for turn in msg for item in turn["content"] if item["type"] == "image")
+
+    @staticmethod
+    def semantic_message(image, question: str):
+        return [
+            {
+                "role": "user",
+                "content": [
+                    {"type": "image", "image": image},
+                    {"type": "text", "text": f"{question}. Please answer 'Yes' or 'No' only."}
+                ],
+            }
+        ]
+
+    @classmethod
+    def ocr_message(cls, image):
+        return [
+            {
+                "role": "user",
+                "content": [
+                    {"type": "image", "image": image},
+                    {"type": "text", "text": cls.TEXT_PROMPT}
+                ],
+            }
+        ]
+
+    def infer_semantic(self, images: list, question: str):
+        messages = [self.semantic_message(image, question) for image in images]
+        return self.batch_inference(messages)
+
+    def infer_semantic_pairs(self, pairs: list, batch_size: int = 16):
+        # pairs of (image, question) from any number of tiles, questions and prompts
+        answers = []
+        batch_size = self.call_size(len(pairs), batch_size)
+        for start in range(0, len(pairs), batch_size):
+            messages = [self.semantic_message(image, question) for image, question in pairs[start:start + batch_size]]
+            answers.extend(self.batch_inference(messages))
+        return answers
+
+    def infer_semantic_probs(self, pairs: list, batch_size: int = 16, vision_cache: dict = None):
+        # (answer, probability of "Yes") for each (image, question) pair, without decoding.
+        # With a vision_cache, each image goes through the vision tower once, the dict is keyed
+        # by id(image) so it must not outlive the images.
+        outputs = []
+        batch_size = self.call_size(len(pairs), batch_size)
+        for start in range(0, len(pairs), batch_size):
+            batch = pairs[start:start + batch_size]
+            messages = [self.semantic_message(image, question) for image, question in batch]
+            if vision_cache is None:
+                outputs.extend(self.batch_yes_no(messages))
+                continue
+
+            outputs.extend(self._cached(messages, "yes_no", lambda misses: self._yes_no_with_vision_cache(misses, vision_cache), 1))
+        return outputs
+
+    def _yes_no_with_vision_cache(self, messages, vision_cache):
+        image_features = []
+        for msg in messages:
+            image = self.message_image(msg)
+            if id(image) not in vision_cache:
+                vision_cache[id(image)] = self.encode_image(image)
+            image_features.append(vision_cache[id(image)])
+        return self.batch_yes_no_with_features(messages, image_features)
+
+    def infer_ocr(self, images: list, max_new_tokens: int = 128):
+        messages = [self.ocr_message(image) for image in images]
+        return self.batch_inference(messages, max_new_tokens=max_new_tokens)
+
+
+class StyleEmbeddingBackend:
+    # style embeddings compared against the reference embeddings of scripts/style
+    input_size = 224
+
+    @staticmethod
+    def build_preprocess():
+        # picklable on its own, the preprocess pool builds it in every worker
+        raise NotImplementedError
+
+    def embed_pixels(self, pixel_values):
+        raise NotImplementedError
+
+    def get_style_embedding(self, image):
+        image = open_image(image).convert('RGB')
+        return self.embed_pixels(self.preprocess(image).unsqueeze(0))
+
+    def get_style_embeddings(self, images):
+        # one stacked batch, as the preprocess pool hands it over, so both paths give the same embeddings
+        import torch
+        return self.embed_pixels(torch.stack([self.preprocess(open_image(image).convert('RGB')) for image in images]))
+
+
+class TextImageBackend:
+    input_size = 336
+
+    def text_img_similarity_score(self, image_list, text_prompt):
+        # similarity of each image to the text
+        raise NotImplementedError
+
+
+class ImageDistanceBackend:
+    input_size = 224
+
+    def distance(self, image_1, image_2):
+        raise NotImplementedError
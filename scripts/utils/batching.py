@@ -0,0 +1,51 @@
+import time
+
+
+class TokenBudgetBatcher:
+    def __init__(self, token_budget: int = None):
+        # without a budget every call is run as the batch the caller made
+        self.token_budget = token_budget
+        self.batches = 0
+        self.requests = 0
+        self.prompt_tokens = 0
+        self.padded_tokens = 0
+        self.seconds = 0.0
+
+    def plan(self, lengths, new_tokens):
+        # requests sorted by prompt length are cut into batches whose padded prompts plus
+        # generated tokens fit the budget, so each batch holds requests of similar length
+        if self.token_budget is None:
+            return [list(range(len(lengths)))] if lengths else []
+
+        batches, batch, longest = [], [], 0
+        for idx in sorted(range(len(lengths)), key=lambda idx: lengths[idx]):
+            if batch and (len(batch) + 1) * (max(longest, lengths[idx]) + new_tokens) > self.token_budget:
+                batches.append(batch)
+                batch, longest = [], 0
+            batch.append(idx)
+            longest = max(longest, lengths[idx])
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def run(self, requests, lengths, new_tokens, run):
+        # run(batch of requests) returns one output per request, outputs come back in request order
+        outputs = [None] * len(requests)
+        for batch in self.plan(lengths, new_tokens):
+            start_time = time.perf_counter()
+            for idx, output in zip(batch, run([requests[idx] for idx in batch])):
+                outputs[idx] = output
+            self.seconds += time.perf_counter() - start_time
+            self.batches += 1
+            self.requests += len(batch)
+            self.prompt_tokens += sum(lengths[idx] for idx in batch)
+            self.padded_tokens += len(batch) * max(lengths[idx] for idx in batch)
+        return outputs
+
+    def stats(self):
+        padding = 1 - self.prompt_tokens / self.padded_tokens if self.padded_tokens else 0.0
+        tokens_per_second = self.prompt_tokens / self.seconds if self.seconds else 0.0
+        return (
+            f"VLM batching: {self.requests} requests in {self.batches} batches, "
+            f"{padding:.1%} of prompt tokens are padding, {tokens_per_second:.0f} prompt tokens/s."
+        )
@@ -0,0 +1,27 @@
+
+
+def list_image_dir(dirname, id_length: int = 3):
+    import megfile
+    # a single listing of the directory replaces one glob per prompt id
+    images = {}
+    for path in sorted(megfile.smart_glob(dirname + '/*')):
+        images.setdefault(path.split('/')[-1][:id_length], []).append(path)
+    return images
+
+
+def report_image_dir(dirname, images, expected_ids):
+    missing = [id for id in expected_ids if id not in images]
+    duplicates = [id for id in expected_ids if len(images.get(id, [])) > 1]
+    if missing:
+        print(f"{len(missing)} ids have no image in {dirname}: {', '.join(missing)}")
+    if duplicates:
+        print(f"{len(duplicates)} ids have several images in {dirname} and are skipped: {', '.join(duplicates)}")
+    return missing, duplicates
+
+
+def build_image_index(dirnames: dict, expected_ids):
+    index = {}
+    for key, dirname in dirnames.items():
+        index[key] = list_image_dir(dirname)
+        report_image_dir(dirname, index[key], expected_ids)
+    return index
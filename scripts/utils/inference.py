@@ -1,25 +1,24 @@
-import os
-from PIL import Image
 import torch
-torch.cuda.empty_cache()
 import torchvision
 torchvision.disable_beta_transforms_warning()
 import torchvision.transforms.functional as F
 from torchvision import transforms
 from transformers import (AutoModel, AutoProcessor, AutoTokenizer, AutoConfig,
                             CLIPImageProcessor, CLIPVisionModelWithProjection)
-from qwen_vl_utils import process_vision_info
+from qwen_vl_utils import process_vision_info, smart_resize
+from scripts.utils.utils import open_image
+from scripts.utils.backends import VLMBackend, StyleEmbeddingBackend, TextImageBackend, ImageDistanceBackend
 
-os.environ["CUDA_VISIBLE_DEVICES"] = "0"
 torch.manual_seed(42) 
 torch.cuda.manual_seed_all(42)
 
-class Qwen2_5VLBatchInferencer:
+class Qwen2_5VLBatchInferencer(VLMBackend):
     def __init__(self, model_path: str = "Qwen/Qwen2.5-VL-7B-Instruct", 
                     device: str = "cuda", 
                     dtype=torch.bfloat16, 
-                    use_flash_attention: bool = True):
-        
+                    use_flash_attention: bool = True,
+                    chat_templates: dict = None):
+        super().__init__(model_path, chat_templates)
         attn_impl = "flash_attention_2" if use_flash_attention else "eager"
         
         from transformers import Qwen2_5_VLForConditionalGeneration
@@ -31,21 +30,37 @@ class Qwen2_5VLBatchInferencer:
             device_map="auto",
         )
         self.processor = AutoProcessor.from_pretrained(model_path)
+        # token counts of the rendered chat templates
+        self.text_tokens = {}
         self.device = torch.device(device)
-        self.TEXT_PROMPT = (
-            "Recognize the text in the image, only reply with the text content, "
-            "but avoid repeating previously mentioned content. "
-            "If no text is recognized, please reply with 'No text recognized'."
-        )
+        # first tokens of the answers to semantic questions, EN and ZH
+        tokenizer = self.processor.tokenizer
+        self.yes_token_ids = list(dict.fromkeys(tokenizer.encode(word, add_special_tokens=False)[0] for word in ("Yes", "yes", "是")))
+        self.no_token_ids = list(dict.fromkeys(tokenizer.encode(word, add_special_tokens=False)[0] for word in ("No", "no", "否")))
+
+    def prompt_tokens(self, msg):
+        # prompt length from the resized image in 28x28 patches and the tokenized chat template
+        width, height = open_image(self.message_image(msg)).size
+        resized_height, resized_width = smart_resize(height, width)
+        text = self.render_chat_template(msg)
+        if text not in self.text_tokens:
+            self.text_tokens[text] = len(self.processor.tokenizer.encode(text))
+        return resized_height * resized_width // 28 ** 2 + self.text_tokens[text]
+
+    def render_chat_template(self, msg):
+        # every message has one image and one question, so the text alone decides the rendering
+        key = self.message_text(msg)
+        text = self.chat_templates.get(key)
+        if text is None:
+            text = self.processor.apply_chat_template(msg, tokenize=False, add_generation_prompt=True)
+            self.chat_templates[key] = text
+        return text
 
-    def batch_inference(self, messages, max_new_tokens=128):
-        texts = [
-            self.processor.apply_chat_template(msg, tokenize=False, add_generation_prompt=True)
-            for msg in messages
-        ]
+    def _prepare_inputs(self, messages):
+        texts = [self.render_chat_template(msg) for msg in messages]
         image_inputs, video_inputs = process_vision_info(messages)
 
-        inputs = self.processor(
+        return self.processor(
             text=texts,
             images=image_inputs,
             videos=video_inputs,
@@ -53,6 +68,9 @@ class Qwen2_5VLBatchInferencer:
             return_tensors="pt",
         ).to(self.device)
 
+    def generate(self, messages, max_new_tokens=128):
+        inputs = self._prepare_inputs(messages)
+
         with torch.no_grad():
             generated_ids = self.model.generate(**inputs, max_new_tokens=max_new_tokens)
             generated_ids_trimmed = [
@@ -65,40 +83,74 @@ class Qwen2_5VLBatchInferencer:
             )
         return output_texts
 
-    def infer_semantic(self, images_path: list, question: str):
-        messages = []
-        for image_path in images_path:
-            messages.append([
-                {
-                    "role": "user",
-                    "content": [
-                        {"type": "image", "image": image_path},
-                        {"type": "text", "text": f"{question}. Please answer 'Yes' or 'No' only."}
-                    ],
-                }
-            ])
-        return self.batch_inference(messages)
-
-    def infer_ocr(self, images_path: list, max_new_tokens: int = 128):
-        messages = []
-        for image_path in images_path:
-            messages.append([
-                {
-                    "role": "user",
-                    "content": [
-                        {"type": "image", "image": image_path},
-                        {"type": "text", "text": self.TEXT_PROMPT}
-                    ],
-                }
-            ])
-        return self.batch_inference(messages, max_new_tokens=max_new_tokens)
-    
-
-class CSDStyleEmbedding:
+    def yes_no(self, messages):
+        inputs = self._prepare_inputs(messages)
+
+        with torch.no_grad():
+            # a single prefill step, only the logits at the answer position are needed
+            outputs = self.model.generate(
+                **inputs, max_new_tokens=1, output_logits=True, return_dict_in_generate=True
+            )
+        return self._yes_no_from_logits(outputs.logits[0])
+
+    def _yes_no_from_logits(self, logits):
+        candidate_probs = torch.softmax(logits.float()[:, self.yes_token_ids + self.no_token_ids], dim=-1)
+        yes_probs = candidate_probs[:, :len(self.yes_token_ids)].sum(dim=-1).tolist()
+        return [("Yes" if yes_prob > 0.5 else "No", yes_prob) for yes_prob in yes_probs]
+
+    def encode_image(self, image):
+        image_inputs, _ = process_vision_info([self.semantic_message(image, "")])
+        inputs = self.processor.image_processor(images=image_inputs, return_tensors="pt")
+        image_grid_thw = inputs.image_grid_thw.to(self.device)
+
+        with torch.no_grad():
+            image_embeds = self.model.visual(
+                inputs.pixel_values.to(self.device, dtype=self.model.visual.dtype), grid_thw=image_grid_thw
+            )
+        return image_embeds, image_grid_thw
+
+    def batch_yes_no_with_features(self, messages, image_features):
+        # image_features holds the (image_embeds, image_grid_thw) of each message from encode_image,
+        # so only the language model runs here
+        image_token = self.processor.image_token
+        texts = []
+        for msg, (image_embeds, _) in zip(messages, image_features):
+            text = self.render_chat_template(msg)
+            texts.append(text.replace(image_token, image_token * image_embeds.shape[0]))
+        inputs = self.processor.tokenizer(texts, padding=True, return_tensors="pt").to(self.device)
+        image_grid_thw = torch.cat([grid_thw for _, grid_thw in image_features])
+
+        with torch.no_grad():
+            inputs_embeds = self.model.get_input_embeddings()(inputs.input_ids)
+            image_mask = inputs.input_ids == self.model.config.image_token_id
+            inputs_embeds[image_mask] = torch.cat([embeds for embeds, _ in image_features]).to(inputs_embeds.dtype)
+            position_ids, _ = self.model.get_rope_index(
+                inputs.input_ids, image_grid_thw, None, None, inputs.attention_mask
+            )
+            hidden_states = self.model.model(
+                input_ids=None,
+                position_ids=position_ids,
+                attention_mask=inputs.attention_mask,
+                inputs_embeds=inputs_embeds,
+                use_cache=False,
+            )[0]
+            # the answer position is the last non-padding token, whichever side is padded
+            mask = inputs.attention_mask
+            last_positions = mask.shape[1] - 1 - mask.flip(-1).argmax(-1)
+            last_hidden = hidden_states[torch.arange(len(texts), device=hidden_states.device), last_positions]
+            logits = self.model.lm_head(last_hidden)
+        return self._yes_no_from_logits(logits)
+
+
+class CSDStyleEmbedding(StyleEmbeddingBackend):
     def __init__(self, model_path: str = "scripts/style/models/checkpoint.pth", device: str = "cuda"):
         self.device = torch.device(device)
         self.model = self._load_model(model_path).to(self.device)
-        self.preprocess = transforms.Compose([
+        self.preprocess = self.build_preprocess()
+
+    @staticmethod
+    def build_preprocess():
+        return transforms.Compose([
             transforms.Resize(size=224, interpolation=F.InterpolationMode.BICUBIC),
             transforms.CenterCrop(224),
             transforms.ToTensor(),
@@ -118,29 +170,33 @@ class CSDStyleEmbedding:
         model.load_state_dict(state_dict, strict=False)
         return model
 
-    def get_style_embedding(self, image_path: str):
-        image = Image.open(image_path).convert('RGB')
-        image_tensor = self.preprocess(image).unsqueeze(0).to(self.device)
+    def embed_pixels(self, pixel_values):
         with torch.no_grad():
-            _, _, style_output = self.model(image_tensor)
+            _, _, style_output = self.model(pixel_values.to(self.device))
         return style_output
 
 
-class SEStyleEmbedding:
+class SEStyleEmbedding(StyleEmbeddingBackend):
     def __init__(self, pretrained_path: str = "xingpng/OneIG-StyleEncoder", device: str = "cuda", dtype=torch.bfloat16):
         self.device = torch.device(device)
         self.dtype = dtype
         self.image_encoder = CLIPVisionModelWithProjection.from_pretrained(pretrained_path)
         self.image_encoder.to(self.device, dtype=self.dtype)
         self.image_encoder.eval()
-        self.processor = CLIPImageProcessor()
+        self.preprocess = self.build_preprocess()
+
+    @staticmethod
+    def build_preprocess():
+        processor = CLIPImageProcessor()
+        def preprocess(image):
+            return processor(images=image, return_tensors="pt").pixel_values[0]
+        return preprocess
 
     def _l2_normalize(self, x):
         return torch.nn.functional.normalize(x, p=2, dim=-1)
 
-    def get_style_embedding(self, image_path: str):
-        image = Image.open(image_path).convert('RGB')
-        inputs = self.processor(images=image, return_tensors="pt").pixel_values.to(self.device, dtype=self.dtype)
+    def embed_pixels(self, pixel_values):
+        inputs = pixel_values.to(self.device, dtype=self.dtype)
 
         with torch.no_grad():
             outputs = self.image_encoder(inputs)
@@ -149,7 +205,7 @@ class SEStyleEmbedding:
         return image_embeds_norm
 
 
-class LLM2CLIP:
+class LLM2CLIP(TextImageBackend):
     def __init__(self, processor_model="openai/clip-vit-large-patch14-336", 
                  model_name="microsoft/LLM2CLIP-Openai-L-14-336", 
                  llm_model_name="microsoft/LLM2CLIP-Llama-3-8B-Instruct-CC-Finetuned", 
@@ -180,10 +236,10 @@ class LLM2CLIP:
 
         self.device = device
 
-    def text_img_similarity_score(self, image_path_list, text_prompt):
+    def text_img_similarity_score(self, image_list, text_prompt):
         try:
             captions = [text_prompt]
-            images = [Image.open(image_path) for image_path in image_path_list]
+            images = [open_image(image) for image in image_list]
             
             # Process images and encode text
             input_pixels = self.processor(images=images, return_tensors="pt").pixel_values.to(self.device)
@@ -206,3 +262,17 @@ class LLM2CLIP:
         except Exception as e:
             print(f"Error: {e}")
             return None
+
+
+class DreamSimDistance(ImageDistanceBackend):
+    def __init__(self, device: str = "cuda"):
+        from dreamsim import dreamsim
+
+        self.device = device
+        self.model, self.preprocess = dreamsim(pretrained=True, device=device)
+
+    def distance(self, image_1, image_2):
+        image_1 = self.preprocess(open_image(image_1)).to(self.device)
+        image_2 = self.preprocess(open_image(image_2)).to(self.device)
+        distance = self.model(image_1, image_2)
+        return distance.item()
@@ -0,0 +1,115 @@
+import os
+import json
+import hashlib
+
+# bump the version of a metric whenever a change to its scoring code changes its results
+SCORING_VERSIONS = {"alignment": 1, "text": 1, "diversity": 1, "style": 2, "reasoning": 1}
+# arguments that change the models or the tiles every metric sees
+BACKEND_ARGS = ["backend"]
+TILE_ARGS = ["black_threshold", "black_check_size", "reduced_decode"]
+SCORING_ARGS = {"alignment": ["semantic_mode", "soft_alignment"]}
+
+
+def config_version(args, metric, model_id=None):
+    # model_id is the checkpoint of the VLM that answers the questions of a metric
+    config = {name: getattr(args, name) for name in BACKEND_ARGS + TILE_ARGS + SCORING_ARGS.get(metric, [])}
+    config["version"] = SCORING_VERSIONS[metric]
+    config["model_id"] = model_id
+    return hashlib.sha1(json.dumps(config, sort_keys=True).encode()).hexdigest()[:12]
+
+
+class Journal:
+    def __init__(self, path, metric: str, mode: str, resume: bool = False, config: str = None, tile_cache=None):
+        # append-only JSONL of finished (metric, model, prompt) results, path None keeps nothing
+        self.path = path
+        self.metric = metric
+        self.mode = mode
+        self.config = config
+        self.tile_cache = tile_cache
+        self.records = {}
+        self.fd = None
+        if path is None:
+            return
+
+        if resume and os.path.exists(path):
+            self.records = self._read(path)
+            print(f"Resuming {metric} from {path}, {len(self.records)} results are recorded, those whose inputs changed are scored again.")
+
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        # every record is appended with a single write, so parallel workers can share the file
+        self.fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        # a crash can leave half a line behind, start the next record on a fresh line
+        with open(path, "rb") as f:
+            f.seek(0, os.SEEK_END)
+            if f.tell() > 0:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b"\n":
+                    os.write(self.fd, b"\n")
+
+    def _read(self, path):
+        records = {}
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                if record.get("metric") == self.metric and record.get("mode") == self.mode:
+                    records[(record["model"], record["prompt"])] = (record["result"], record.get("inputs"))
+        return records
+
+    def source(self, image_path):
+        # (content hash, bytes read to compute it or None) of an image, the caller hands the bytes
+        # on to the decoder, so the image is fetched once for both
+        if self.fd is None or image_path is None:
+            return None
+        import megfile
+        if self.tile_cache is not None:
+            return self.tile_cache.source(image_path)
+        with megfile.smart_open(image_path, 'rb') as f:
+            data = f.read()
+        return hashlib.sha1(data).hexdigest(), data
+
+    def inputs(self, source, img_grid):
+        # what a recorded result depends on, a result is reused only while all of it is unchanged
+        if self.fd is None:
+            return None
+        return {
+            "digest": None if source is None else source[0],
+            "grid": list(img_grid),
+            "config": self.config,
+        }
+
+    def done(self, model_name, prompt, inputs=None):
+        record = self.records.get((model_name, prompt))
+        return record is not None and record[1] == inputs
+
+    def get(self, model_name, prompt):
+        record = self.records.get((model_name, prompt))
+        return None if record is None else record[0]
+
+    def record(self, model_name, prompt, result, inputs=None):
+        # the result of a scored work item, or the recorded one when the work item was skipped as done
+        if not self.done(model_name, prompt, inputs):
+            self.write(model_name, prompt, result, inputs)
+        return self.get(model_name, prompt)
+
+    def write(self, model_name, prompt, result, inputs=None):
+        self.records[(model_name, prompt)] = (result, inputs)
+        if self.fd is None:
+            return
+        line = json.dumps(
+            {"metric": self.metric, "mode": self.mode, "model": model_name, "prompt": prompt, "result": result, "inputs": inputs},
+            ensure_ascii=False,
+        )
+        os.write(self.fd, (line + "\n").encode("utf-8"))
+        os.fsync(self.fd)
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+def build_journal(args, metric, tile_cache=None, model_id=None):
+    return Journal(args.journal, metric, args.mode, args.resume, config_version(args, metric, model_id), tile_cache)
@@ -0,0 +1,23 @@
+from scripts.utils.utils import split_mxn_tiles
+
+
+def tile_loader(args, tile_cache=None, min_tile_side=None):
+    # min_tile_side is the input size of the metric's encoder, only used with --reduced_decode
+    if not args.reduced_decode:
+        min_tile_side = None
+
+    def load_tiles(image_path, img_grid, source=None):
+        return split_mxn_tiles(image_path, img_grid, args.black_threshold, args.black_check_size, tile_cache, min_tile_side, source)
+    return load_tiles
+
+
+def journaled_loader(journal, load_tiles):
+    # load stage of the scorers: the journal inputs of a work item are computed once, from the bytes
+    # its tiles are decoded from, and a result the journal already holds is not decoded at all
+    def load(model_name, prompt, image_path, img_grid):
+        source = journal.source(image_path)
+        inputs = journal.inputs(source, img_grid)
+        if image_path is None or journal.done(model_name, prompt, inputs):
+            return inputs, None
+        return inputs, load_tiles(image_path, img_grid, source)
+    return load
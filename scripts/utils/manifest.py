@@ -0,0 +1,173 @@
+import os
+import json
+import pickle
+import argparse
+
+CATEGORIES = {
+    "anime": "Anime_Stylization",
+    "human": "Portrait",
+    "object": "General_Object",
+    "text": "Text_Rendering",
+    "reasoning": "Knowledge_Reasoning",
+    "multilingualism": "Multilingualism",
+}
+
+
+def manifest_sources(mode):
+    suffix = "" if mode == "EN" else "_zh"
+    question_dependency_dir = "scripts/alignment/Q_D"
+    alignment_items = ["anime", "human", "object"] + ([] if mode == "EN" else ["multilingualism"])
+    return {
+        "benchmark": f"OneIG-Bench{'' if mode == 'EN' else '-ZH'}.csv",
+        "alignment": {item: f"{question_dependency_dir}/{item}{suffix}.json" for item in alignment_items},
+        "text": f"scripts/text/text_content{suffix}.csv",
+        "style": "scripts/style/style.csv",
+        "reasoning": f"scripts/reasoning/gt_answer{suffix}.json",
+    }
+
+
+def _source_paths(sources):
+    paths = []
+    for path in sources.values():
+        paths.extend(path.values() if isinstance(path, dict) else [path])
+    return paths
+
+
+def _fingerprint(paths):
+    return {path: (os.stat(path).st_size, os.stat(path).st_mtime_ns) for path in paths if os.path.exists(path)}
+
+
+class Manifest:
+    def __init__(self, mode, records, ids, chat_templates, fingerprint):
+        self.mode = mode
+        # records[(category, id)] holds every per-prompt field any metric needs
+        self.records = records
+        self.ids = ids
+        self.chat_templates = chat_templates
+        self.fingerprint = fingerprint
+
+    def get(self, category, id):
+        return self.records.get((category, id))
+
+    def prompts(self, category, field=None):
+        # records of one category in file order, optionally only those carrying field
+        records = ((id, self.records[(category, id)]) for id in self.ids.get(category, []))
+        return {id: item for id, item in records if field is None or field in item}
+
+    def save(self, path):
+        with open(path, "wb") as f:
+            pickle.dump(self.__dict__, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "rb") as f:
+            return cls(**pickle.load(f))
+
+
+def compile_manifest(mode, processor_path=None):
+    import pandas as pd
+    sources = manifest_sources(mode)
+    records = {}
+    ids = {}
+
+    def record(category, id):
+        if (category, id) not in records:
+            records[(category, id)] = {}
+            ids.setdefault(category, []).append(id)
+        return records[(category, id)]
+
+    if os.path.exists(sources["benchmark"]):
+        source_to_category = {source: category for category, source in CATEGORIES.items()}
+        benchmark_df = pd.read_csv(sources["benchmark"], dtype=str)
+        prompt_column = "prompt_en" if mode == "EN" else "prompt_cn"
+        for row in benchmark_df.to_dict("records"):
+            item = record(source_to_category[row["category"]], row["id"])
+            item["prompt"] = row[prompt_column]
+            for column in ("type", "prompt_length", "class"):
+                if column in row:
+                    item[column] = None if pd.isna(row[column]) else row[column]
+
+    for category, json_path in sources["alignment"].items():
+        with open(json_path, "r", encoding="utf-8") as f:
+            question_dependency = json.load(f)
+        for id, item in question_dependency.items():
+            question = item["question"]
+            dependency = item["dependency"]
+            # the files store both as JSON strings inside JSON
+            if isinstance(question, str):
+                question = json.loads(question)
+            if isinstance(dependency, str):
+                dependency = json.loads(dependency)
+            entry = record(category, id)
+            entry["question"] = {int(k): v for k, v in question.items()}
+            entry["dependency"] = {int(k): v for k, v in dependency.items()}
+
+    text_df = pd.read_csv(sources["text"], dtype=str)
+    for id, text_content in zip(text_df["id"], text_df["text_content"]):
+        record("text", id)["text_content"] = text_content
+
+    style_df = pd.read_csv(sources["style"], dtype=str)
+    for id, style in zip(style_df["id"], style_df["class"]):
+        style = str(style)
+        record("anime", id)["style"] = None if style[:3] == "nan" else style.lower().replace(' ', '_')
+
+    with open(sources["reasoning"], "r", encoding="utf-8") as f:
+        for id, answer in json.load(f).items():
+            record("reasoning", id)["answer"] = answer
+
+    chat_templates = {}
+    if processor_path is not None:
+        chat_templates = render_chat_templates(records.values(), processor_path)
+
+    return Manifest(mode, records, ids, chat_templates, _fingerprint(_source_paths(sources)))
+
+
+def render_chat_templates(records, processor_path):
+    from transformers import AutoProcessor
+    from scripts.utils.backends import VLMBackend
+
+    processor = AutoProcessor.from_pretrained(processor_path)
+    messages = [VLMBackend.ocr_message("")]
+    for item in records:
+        messages.extend(VLMBackend.semantic_message("", question) for question in item.get("question", {}).values())
+
+    chat_templates = {}
+    for msg in messages:
+        key = VLMBackend.message_text(msg)
+        if key not in chat_templates:
+            chat_templates[key] = processor.apply_chat_template(msg, tokenize=False, add_generation_prompt=True)
+    return chat_templates
+
+
+def default_manifest_path(mode):
+    return f"scripts/manifest_{mode}.pkl"
+
+
+def load_manifest(mode, path=None):
+    path = path or default_manifest_path(mode)
+    if os.path.exists(path):
+        manifest = Manifest.load(path)
+        if manifest.mode == mode and manifest.fingerprint == _fingerprint(manifest.fingerprint):
+            return manifest
+        print(f"The manifest {path} is out of date, compiling the benchmark files again.")
+    return compile_manifest(mode)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compile the benchmark files into one manifest.")
+    parser.add_argument("--mode", type=str, nargs="+", default=["EN", "ZH"], help="Language modes to compile.")
+    parser.add_argument("--processor", type=str, default=None, help="Processor used to pre-render the VLM chat templates.")
+    parser.add_argument("--output_dir", type=str, default=None, help="Directory of the manifests, next to the benchmark files by default.")
+    args = parser.parse_args()
+
+    for mode in args.mode:
+        manifest = compile_manifest(mode, args.processor)
+        path = default_manifest_path(mode)
+        if args.output_dir:
+            path = os.path.join(args.output_dir, os.path.basename(path))
+        manifest.save(path)
+        print(f"Manifest with {len(manifest.records)} prompts saved to {path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,37 @@
+import argparse
+import importlib
+from scripts.utils.manifest import load_manifest
+from scripts.utils.parallel import load_partial, manifest_digest, merge_partials
+from scripts.utils.run_metrics import METRICS
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Merge the partial results of the shards of one evaluation into its CSVs.")
+    parser.add_argument("--metric", type=str, nargs="+", default=METRICS, choices=METRICS, help="Metrics to merge.")
+    parser.add_argument("--mode", type=str, default="EN", choices=["EN", "ZH"], help="Language mode of the evaluation.")
+    parser.add_argument("--partial_dir", type=str, default="results/partials", help="Directory holding the partial results of all shards.")
+    args = parser.parse_args()
+
+    import megfile
+
+    for metric in args.metric:
+        paths = sorted(megfile.smart_glob(f"{args.partial_dir}/{metric}_{args.mode}_shard*of*.json"))
+        if not paths:
+            print(f"No partial results of {metric} in {args.partial_dir}, skipped.")
+            continue
+
+        partials = [load_partial(path) for path in paths]
+        results = merge_partials(partials)
+        print(f"Merging {len(results)} {metric} results of {len(partials)} shards.")
+
+        # the CSVs are written with the settings the shards were run with
+        shard_args = argparse.Namespace(**partials[0]["args"])
+        manifest = load_manifest(shard_args.mode, shard_args.manifest)
+        if manifest_digest(manifest) != partials[0]["manifest"]:
+            raise ValueError(f"The benchmark files changed since the {metric} shards were run.")
+        module = importlib.import_module(f"scripts.{metric}.{metric}_score")
+        module.write_results(shard_args, manifest, results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+import hashlib
+import numpy as np
+import torch
+from PIL import Image
+from scripts.utils.utils import open_image
+from scripts.utils.backends import VLMBackend, StyleEmbeddingBackend, TextImageBackend, ImageDistanceBackend
+
+# Deterministic stand-ins for the real models. Every output is a function of a small thumbnail of
+# the image and of the text, so runs are reproducible on CPU without any checkpoint. The device
+# argument of the real backends is accepted and ignored.
+
+THUMBNAIL_SIZE = 16
+
+
+def thumbnail(image):
+    image = open_image(image).convert('RGB').resize((THUMBNAIL_SIZE, THUMBNAIL_SIZE), Image.BILINEAR)
+    return np.asarray(image, dtype=np.float32) / 255
+
+
+def thumbnail_tensor(image):
+    return torch.from_numpy(thumbnail(image).transpose(2, 0, 1).copy())
+
+
+def unit_hash(*parts):
+    digest = hashlib.sha1()
+    for part in parts:
+        digest.update(part if isinstance(part, bytes) else str(part).encode("utf-8"))
+    return int(digest.hexdigest()[:8], 16) / 0xffffffff
+
+
+def random_projection(seed, dim):
+    generator = torch.Generator().manual_seed(seed)
+    return torch.randn(3 * THUMBNAIL_SIZE * THUMBNAIL_SIZE, dim, generator=generator)
+
+
+class MockVLM(VLMBackend):
+    def __init__(self, model_path: str = None, device: str = "cpu", chat_templates: dict = None, **kwargs):
+        super().__init__("mock", chat_templates)
+        self.device = torch.device("cpu")
+
+    def _answer(self, features, msg):
+        text = self.message_text(msg)
+        if text == self.TEXT_PROMPT:
+            digest = hashlib.sha1(features.tobytes()).hexdigest()
+            return " ".join(digest[i:i + 4] for i in range(0, 16, 4)), None
+        yes_prob = unit_hash(features.tobytes(), text)
+        return ("Yes" if yes_prob > 0.5 else "No"), yes_prob
+
+    def generate(self, messages, max_new_tokens=128):
+        return [self._answer(thumbnail(self.message_image(msg)), msg)[0] for msg in messages]
+
+    def yes_no(self, messages):
+        return [self._answer(thumbnail(self.message_image(msg)), msg) for msg in messages]
+
+    def encode_image(self, image):
+        return thumbnail(image)
+
+    def batch_yes_no_with_features(self, messages, image_features):
+        return [self._answer(features, msg) for msg, features in zip(messages, image_features)]
+
+
+class MockCSDStyleEmbedding(StyleEmbeddingBackend):
+    # sizes and dtypes match the reference embeddings in scripts/style
+    embed_dim = 768
+    dtype = torch.float32
+    seed = 0
+
+    def __init__(self, model_path: str = None, device: str = "cpu", **kwargs):
+        self.device = torch.device("cpu")
+        self.preprocess = self.build_preprocess()
+        self.projection = random_projection(self.seed, self.embed_dim)
+
+    @staticmethod
+    def build_preprocess():
+        return thumbnail_tensor
+
+    def embed_pixels(self, pixel_values):
+        features = pixel_values.reshape(len(pixel_values), -1).float() - 0.5
+        embeds = torch.nn.functional.normalize(features @ self.projection, p=2, dim=-1)
+        return embeds.to(self.dtype)
+
+
+class MockSEStyleEmbedding(MockCSDStyleEmbedding):
+    embed_dim = 1280
+    dtype = torch.bfloat16
+    seed = 1
+
+    def __init__(self, pretrained_path: str = None, device: str = "cpu", **kwargs):
+        super().__init__(device=device)
+
+
+class MockTextImage(TextImageBackend):
+    embed_dim = 64
+
+    def __init__(self, device: str = "cpu", **kwargs):
+        self.device = "cpu"
+        self.projection = random_projection(2, self.embed_dim)
+
+    def text_img_similarity_score(self, image_list, text_prompt):
+        pixel_values = torch.stack([thumbnail_tensor(image) for image in image_list])
+        image_features = torch.nn.functional.normalize((pixel_values.reshape(len(image_list), -1) - 0.5) @ self.projection, dim=-1)
+        generator = torch.Generator().manual_seed(int(unit_hash(text_prompt) * 0x7fffffff))
+        text_features = torch.nn.functional.normalize(torch.randn(self.embed_dim, generator=generator), dim=-1)
+        return (image_features @ text_features).tolist()
+
+
+class MockImageDistance(ImageDistanceBackend):
+    def __init__(self, device: str = "cpu", **kwargs):
+        self.device = "cpu"
+
+    def distance(self, image_1, image_2):
+        return float(np.abs(thumbnail(image_1) - thumbnail(image_2)).mean())
@@ -0,0 +1,167 @@
+import os
+import sys
+import json
+import hashlib
+import tempfile
+import subprocess
+from scripts.utils.journal import config_version
+
+# arguments every shard of one evaluation has to agree on
+SHARD_ARGS = ["mode", "model_names", "image_grid", "class_items", "backend"]
+
+
+class Sharding:
+    def __init__(self, manifest, shard_index: int = 0, num_shards: int = 1):
+        self.shard_index = shard_index
+        self.num_shards = num_shards
+        # prompts are dealt round robin in manifest order, so every shard gets a stable and balanced share
+        self.positions = {key: position for position, key in enumerate(manifest.records)}
+
+    def owns(self, category, id):
+        if self.num_shards == 1:
+            return True
+        position = self.positions.get((category, id))
+        if position is None:
+            position = int(hashlib.sha1(f"{category}_{id}".encode()).hexdigest(), 16)
+        return position % self.num_shards == self.shard_index
+
+
+def manifest_digest(manifest):
+    # the content of the benchmark, unlike the file fingerprint it is the same on every machine
+    records = [[category, id, manifest.records[(category, id)]] for category, id in sorted(manifest.records)]
+    return hashlib.sha1(json.dumps(records, sort_keys=True, ensure_ascii=False, default=str).encode()).hexdigest()
+
+
+def partial_path(partial_dir, metric, mode, shard_index, num_shards):
+    return os.path.join(partial_dir, f"{metric}_{mode}_shard{shard_index}of{num_shards}.json")
+
+
+def save_partial(path, args, metric, manifest, results):
+    partial = {
+        "metric": metric,
+        "mode": args.mode,
+        "shard_index": args.shard_index,
+        "num_shards": args.num_shards,
+        "config": config_version(args, metric),
+        "manifest": manifest_digest(manifest),
+        "args": vars(args),
+        "results": [[model_name, prompt, result] for (model_name, prompt), result in results.items()],
+    }
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(partial, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+
+def load_partial(path):
+    with open(path, "r", encoding="utf-8") as f:
+        partial = json.load(f)
+    partial["results"] = {(model_name, prompt): result for model_name, prompt, result in partial["results"]}
+    return partial
+
+
+def visible_devices():
+    # the GPUs the workers can be placed on, CUDA_VISIBLE_DEVICES when it is set, else every GPU of the machine
+    visible = os.environ.get("CUDA_VISIBLE_DEVICES")
+    if visible is not None:
+        return [device.strip() for device in visible.split(",") if device.strip()]
+    try:
+        listing = subprocess.run(["nvidia-smi", "-L"], capture_output=True, text=True, check=True).stdout
+        count = sum(line.startswith("GPU ") for line in listing.splitlines())
+    except (OSError, subprocess.CalledProcessError):
+        import torch
+        count = torch.cuda.device_count()
+    return [str(idx) for idx in range(count)]
+
+
+def worker_devices(num_workers, device="cuda"):
+    # one visible GPU per worker, None leaves the environment of the workers as it is
+    if not device.startswith("cuda"):
+        return [None] * num_workers
+    devices = visible_devices()
+    if num_workers > len(devices):
+        raise ValueError(
+            f"--workers {num_workers} needs {num_workers} GPUs, the visible ones are ({','.join(devices) or 'none'}). "
+            f"Set CUDA_VISIBLE_DEVICES to {num_workers} GPUs or lower --workers."
+        )
+    return devices[:num_workers]
+
+
+def run_workers(args, metric):
+    # every worker is the same scorer restricted to one shard, its results come back as a partial file.
+    # Within shard i of N, worker k takes shard i + k * N of N * workers, a subset of shard i.
+    module = f"scripts.{metric}.{metric}_score"
+    num_shards = args.num_shards * args.workers
+    with tempfile.TemporaryDirectory(prefix=f"{metric}_workers_") as partial_dir:
+        processes = []
+        for worker_id, device in enumerate(worker_devices(args.workers, args.device)):
+            shard_index = args.shard_index + worker_id * args.num_shards
+            command = [
+                sys.executable, "-m", module, *sys.argv[1:],
+                "--workers", "1",
+                "--shard_index", str(shard_index),
+                "--num_shards", str(num_shards),
+                "--partial_file", partial_path(partial_dir, metric, args.mode, shard_index, num_shards),
+            ]
+            env = dict(os.environ) if device is None else dict(os.environ, CUDA_VISIBLE_DEVICES=device)
+            processes.append(subprocess.Popen(command, env=env))
+
+        failed = [worker_id for worker_id, process in enumerate(processes) if process.wait() != 0]
+        if failed:
+            raise RuntimeError(f"The {metric} workers {failed} failed, finished results are kept in --journal for --resume.")
+
+        results = {}
+        for worker_id in range(args.workers):
+            shard_index = args.shard_index + worker_id * args.num_shards
+            results.update(load_partial(partial_path(partial_dir, metric, args.mode, shard_index, num_shards))["results"])
+    return results
+
+
+def merge_partials(partials):
+    # results of all the shards of one evaluation, each shard exactly once and all run with the same settings
+    first = partials[0]
+    for partial in partials:
+        for key in ["metric", "num_shards", "config", "manifest"]:
+            if partial[key] != first[key]:
+                raise ValueError(f"Shard {partial['shard_index']} has {key} {partial[key]!r}, shard {first['shard_index']} has {first[key]!r}.")
+        for name in SHARD_ARGS:
+            if partial["args"].get(name) != first["args"].get(name):
+                raise ValueError(f"Shard {partial['shard_index']} was run with --{name} {partial['args'].get(name)!r}, shard {first['shard_index']} with {first['args'].get(name)!r}.")
+
+    shard_indices = [partial["shard_index"] for partial in partials]
+    duplicated = sorted({shard_index for shard_index in shard_indices if shard_indices.count(shard_index) > 1})
+    if duplicated:
+        raise ValueError(f"Shards {duplicated} are given more than once.")
+    missing = sorted(set(range(first["num_shards"])) - set(shard_indices))
+    if missing:
+        raise ValueError(f"Shards {missing} of {first['num_shards']} are missing.")
+
+    results = {}
+    for partial in partials:
+        overlap = results.keys() & partial["results"].keys()
+        if overlap:
+            raise ValueError(f"Shard {partial['shard_index']} repeats {len(overlap)} results of other shards, e.g. {sorted(overlap)[0]}.")
+        results.update(partial["results"])
+    return results
+
+
+def run_metric(args, metric, manifest, score, write_results):
+    # score(args, manifest, sharding) returns {(model_name, prompt): result} and
+    # write_results(args, manifest, results) turns them into the output CSVs
+    if not 0 <= args.shard_index < args.num_shards:
+        raise ValueError(f"--shard_index must be in [0, {args.num_shards}), got {args.shard_index}.")
+    # one shard of a split evaluation leaves a partial file for scripts.utils.merge_shards
+    if args.partial_file is None and args.num_shards > 1:
+        args.partial_file = partial_path(args.partial_dir, metric, args.mode, args.shard_index, args.num_shards)
+
+    if args.workers > 1:
+        results = run_workers(args, metric)
+    else:
+        results = score(args, manifest, Sharding(manifest, args.shard_index, args.num_shards))
+
+    if args.partial_file:
+        save_partial(args.partial_file, args, metric, manifest, results)
+        print(f"Results of shard {args.shard_index} of {args.num_shards} saved to {args.partial_file}")
+    else:
+        write_results(args, manifest, results)
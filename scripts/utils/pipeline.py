@@ -0,0 +1,144 @@
+import time
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+_DONE = object()
+
+
+class _Failure:
+    def __init__(self, error):
+        self.error = error
+
+
+class Stage:
+    # kind "io" and "cpu" run fn on a pool of workers threads, or on the given executor, "model" runs it
+    # on a single thread that owns the inference device. The first stage gets fn(item), the next
+    # ones fn(item, output of the previous stage).
+    def __init__(self, name, fn, kind="io", workers=1, executor=None):
+        self.name = name
+        self.fn = fn
+        self.kind = kind
+        self.workers = 1 if kind == "model" else max(1, workers)
+        self.executor = executor
+        self.items = 0
+        # seconds spent in fn, waiting for an input, and waiting for room in the next queue
+        self.busy = 0.0
+        self.starved = 0.0
+        self.blocked = 0.0
+
+
+class Pipeline:
+    def __init__(self, name, stages, queue_size: int = 8):
+        self.name = name
+        self.stages = stages
+        # items waiting between two stages, a full queue holds back the stages before it
+        self.queue_size = max(1, queue_size)
+        self.consumer = Stage("consume", None, "caller")
+        self.wall = 0.0
+
+    def run(self, items):
+        # yields (item, output of the last stage) as they finish, the body of the caller's loop is the last stage
+        items = list(items)
+        loop = asyncio.new_event_loop()
+        thread = threading.Thread(target=loop.run_forever, daemon=True)
+        thread.start()
+        sink = asyncio.Queue(self.queue_size)
+        executors = [
+            stage.executor or ThreadPoolExecutor(max_workers=stage.workers, thread_name_prefix=f"{self.name}_{stage.name}")
+            for stage in self.stages
+        ]
+        asyncio.run_coroutine_threadsafe(self._run(items, sink, executors), loop)
+        start_time = time.perf_counter()
+        try:
+            while True:
+                wait_start = time.perf_counter()
+                entry = asyncio.run_coroutine_threadsafe(sink.get(), loop).result()
+                self.consumer.starved += time.perf_counter() - wait_start
+                if entry is _DONE:
+                    break
+                if isinstance(entry, _Failure):
+                    raise entry.error
+                busy_start = time.perf_counter()
+                yield entry
+                self.consumer.busy += time.perf_counter() - busy_start
+                self.consumer.items += 1
+        finally:
+            # an early exit or an error stops every stage, the loop goes away only once all of them finished
+            asyncio.run_coroutine_threadsafe(self._shutdown(), loop).result()
+            for stage, executor in zip(self.stages, executors):
+                if stage.executor is None:
+                    executor.shutdown(wait=True, cancel_futures=True)
+            loop.call_soon_threadsafe(loop.stop)
+            thread.join()
+            loop.close()
+            self.wall = time.perf_counter() - start_time
+            print(self.stats())
+
+    @staticmethod
+    async def _shutdown():
+        # the stages, the feeder and a pending read of the caller, a call running in an executor
+        # thread is left to finish and its result dropped
+        tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _run(self, items, sink, executors):
+        queues = [asyncio.Queue(self.queue_size) for _ in self.stages] + [sink]
+
+        async def feed():
+            for item in items:
+                await queues[0].put((item,))
+            for _ in range(self.stages[0].workers):
+                await queues[0].put(_DONE)
+
+        remaining = [stage.workers for stage in self.stages]
+
+        async def work(idx):
+            stage, inbox, outbox = self.stages[idx], queues[idx], queues[idx + 1]
+            loop = asyncio.get_running_loop()
+            while True:
+                wait_start = time.perf_counter()
+                entry = await inbox.get()
+                stage.starved += time.perf_counter() - wait_start
+                if entry is _DONE:
+                    break
+
+                busy_start = time.perf_counter()
+                output = await loop.run_in_executor(executors[idx], stage.fn, *entry)
+                stage.busy += time.perf_counter() - busy_start
+                stage.items += 1
+
+                wait_start = time.perf_counter()
+                await outbox.put((entry[0], output))
+                stage.blocked += time.perf_counter() - wait_start
+
+            # the last worker of a stage closes the next one
+            remaining[idx] -= 1
+            if remaining[idx] == 0:
+                for _ in range(1 if idx + 1 == len(self.stages) else self.stages[idx + 1].workers):
+                    await outbox.put(_DONE)
+
+        tasks = [asyncio.ensure_future(feed())]
+        tasks += [asyncio.ensure_future(work(idx)) for idx, stage in enumerate(self.stages) for _ in range(stage.workers)]
+        try:
+            await asyncio.gather(*tasks)
+        except BaseException as e:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            if isinstance(e, asyncio.CancelledError):
+                raise
+            await sink.put(_Failure(e))
+
+    def stats(self):
+        lines = [f"Pipeline {self.name}: {self.consumer.items} items in {self.wall:.1f} s"]
+        for stage in self.stages + [self.consumer]:
+            capacity = max(self.wall * stage.workers, 1e-9)
+            lines.append(
+                f"  {stage.name} ({stage.kind} x{stage.workers}): {stage.items} items, "
+                f"{stage.busy / capacity:.0%} busy, {stage.starved / capacity:.0%} waiting for input, "
+                f"{stage.blocked / capacity:.0%} held back"
+            )
+        return "\n".join(lines)
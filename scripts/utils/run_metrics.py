@@ -0,0 +1,59 @@
+import os
+import argparse
+import importlib
+from scripts.utils.utils import parse_args
+from scripts.utils.backends import keep_backends_resident, release_backends
+from scripts.utils.manifest import load_manifest
+from scripts.utils.parallel import run_metric
+
+METRICS = ["alignment", "text", "diversity", "style", "reasoning"]
+# image directory of each metric under the image root and its default class items, as in run_overall.sh
+METRIC_DIRS = {"alignment": "", "text": "text", "diversity": "", "style": "anime", "reasoning": "reasoning"}
+CLASS_ITEMS = {"alignment": ["anime", "human", "object"], "diversity": ["anime", "human", "object", "text", "reasoning"]}
+# backend roles each metric builds, a model is released after the last metric using it
+METRIC_ROLES = {"alignment": ["vlm"], "text": ["vlm"], "diversity": ["image_distance"], "style": ["csd", "se"], "reasoning": ["text_image"]}
+
+
+def metric_args(args, metric, class_items=None):
+    # arguments of one scoring script from those of the whole evaluation, whose image_dirname is the image root
+    args = argparse.Namespace(**vars(args))
+    if METRIC_DIRS[metric]:
+        args.image_dirname = os.path.join(args.image_dirname, METRIC_DIRS[metric])
+    if class_items is not None:
+        args.class_items = class_items
+    return args
+
+
+def run_metrics(args, metrics, class_items=None):
+    # the metrics run in the order of METRICS, so alignment and text share the VLM
+    class_items = CLASS_ITEMS if class_items is None else class_items
+    metrics = [metric for metric in METRICS if metric in metrics]
+    keep_backends_resident()
+    for idx, metric in enumerate(metrics):
+        print(f"It's {metric} time.")
+        module = importlib.import_module(f"scripts.{metric}.{metric}_score")
+        manifest = load_manifest(args.mode, args.manifest)
+        run_metric(metric_args(args, metric, class_items.get(metric)), metric, manifest, module.score, module.write_results)
+
+        needed = {role for later in metrics[idx + 1:] for role in METRIC_ROLES[later]}
+        release_backends(set(METRIC_ROLES[metric]) - needed)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Run several metrics in one process, each model is loaded once and freed after its last metric. "
+        "The other arguments are those of the scoring scripts, with --image_dirname the image root as in run_overall.sh."
+    )
+    parser.add_argument("--metrics", type=str, nargs="+", default=METRICS, choices=METRICS, help="Metrics to run.")
+    parser.add_argument("--alignment_class_items", type=str, nargs="+", default=CLASS_ITEMS["alignment"], help="Class items of alignment, add multilingualism in ZH mode.")
+    parser.add_argument("--diversity_class_items", type=str, nargs="+", default=CLASS_ITEMS["diversity"], help="Class items of diversity.")
+    run_args, scorer_argv = parser.parse_known_args()
+
+    args = parse_args(scorer_argv)
+    if args.workers > 1:
+        parser.error("--workers starts the scoring scripts themselves, run them separately or split the run with --shard_index and --num_shards.")
+    run_metrics(args, run_args.metrics, {"alignment": run_args.alignment_class_items, "diversity": run_args.diversity_class_items})
+
+
+if __name__ == "__main__":
+    main()
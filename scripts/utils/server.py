@@ -0,0 +1,140 @@
+import json
+import time
+import argparse
+import importlib
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from scripts.utils.utils import parse_args
+from scripts.utils.backends import keep_backends_resident
+from scripts.utils.manifest import load_manifest
+from scripts.utils.parallel import Sharding
+from scripts.utils.run_metrics import METRICS, CLASS_ITEMS, metric_args
+
+# Resident evaluation service, the models stay loaded between jobs:
+#
+#   python -m scripts.utils.server --port 8765 --preload alignment text --answer_cache vlm_answer_cache.sqlite
+#   curl -X POST localhost:8765/score -d '{"metrics": ["alignment"], "image_dirname": "images", "model_names": ["janus-pro"], "image_grid": ["2,2"]}'
+#
+# A job returns the result of each (model, prompt) of each metric, "write_csv": true also writes the usual CSVs.
+
+# arguments fixed when the server starts, the loaded models depend on them
+SERVER_ARGS = ["backend", "device", "workers", "shard_index", "num_shards", "partial_dir", "partial_file"]
+
+
+class Evaluator:
+    def __init__(self, defaults):
+        self.defaults = defaults
+        self.backends = keep_backends_resident()
+        # the models run one job at a time
+        self.lock = threading.Lock()
+
+    def job_args(self, metric, job):
+        overrides = {name: value for name, value in job.items() if name not in ["metrics", "write_csv"]}
+        unknown = sorted(name for name in overrides if name not in vars(self.defaults) or name in SERVER_ARGS)
+        if unknown:
+            raise ValueError(f"Unknown or fixed arguments {unknown}.")
+
+        args = argparse.Namespace(**{**vars(self.defaults), **overrides})
+        # every model is scored with the grid at its position, a bad pair would only fail in the middle of the job
+        if not isinstance(args.model_names, list) or not isinstance(args.image_grid, list) or len(args.model_names) != len(args.image_grid):
+            raise ValueError(f"model_names and image_grid are lists of the same length, got {args.model_names!r} and {args.image_grid!r}.")
+        for grid in args.image_grid:
+            if not isinstance(grid, str) or not all(side.strip().isdigit() for side in grid.split(',')):
+                raise ValueError(f"An image_grid is columns,rows such as \"2,2\", got {grid!r}.")
+        return metric_args(args, metric, None if "class_items" in job else CLASS_ITEMS.get(metric))
+
+    def preload(self, metrics):
+        # scoring no model builds the backends of a metric and nothing else
+        for metric in metrics:
+            self.run({"metrics": [metric], "model_names": [], "image_grid": [], "class_items": [], "journal": None})
+
+    def run(self, job):
+        metrics = job.get("metrics", METRICS)
+        unknown = sorted(set(metrics) - set(METRICS))
+        if unknown:
+            raise ValueError(f"Unknown metrics {unknown}.")
+        jobs = [(metric, self.job_args(metric, job)) for metric in metrics]
+
+        response = {}
+        with self.lock:
+            for metric, args in jobs:
+                start_time = time.time()
+                module = importlib.import_module(f"scripts.{metric}.{metric}_score")
+                manifest = load_manifest(args.mode, args.manifest)
+                results = module.score(args, manifest, Sharding(manifest))
+                if job.get("write_csv"):
+                    # the CSV names carry the time the module was imported, every job gets its own
+                    module.formatted_time = time.strftime("%Y-%m-%d_%H-%M-%S")
+                    module.write_results(args, manifest, results)
+                response[metric] = {
+                    "results": [[model_name, prompt, result] for (model_name, prompt), result in results.items()],
+                    "seconds": time.time() - start_time,
+                }
+        return response
+
+    def status(self):
+        # a job can build a backend while this runs, list() takes a snapshot of the keys in one step
+        return {
+            "busy": self.lock.locked(),
+            "backends": [{"backend": backend, "role": role, "device": device} for backend, role, device, _ in list(self.backends)],
+        }
+
+
+def handler(evaluator):
+    class Handler(BaseHTTPRequestHandler):
+        def reply(self, code, body):
+            data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+            self.send_response(code)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            if self.path == "/status":
+                self.reply(200, evaluator.status())
+            else:
+                self.reply(404, {"error": f"Unknown path {self.path}."})
+
+        def do_POST(self):
+            if self.path != "/score":
+                self.reply(404, {"error": f"Unknown path {self.path}."})
+                return
+            try:
+                job = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+                if not isinstance(job, dict):
+                    raise ValueError("A job is a JSON object.")
+                self.reply(200, evaluator.run(job))
+            except ValueError as e:
+                self.reply(400, {"error": str(e)})
+            except Exception as e:
+                self.reply(500, {"error": f"{type(e).__name__}: {e}"})
+                raise
+
+    return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Keep the models loaded and score jobs sent over HTTP. "
+        "Any argument of the scoring scripts, e.g. --backend or --answer_cache, sets it for every job."
+    )
+    parser.add_argument("--host", type=str, default="127.0.0.1", help="Address the server listens on.")
+    parser.add_argument("--port", type=int, default=8765, help="Port the server listens on.")
+    parser.add_argument("--preload", type=str, nargs="*", default=[], choices=METRICS, help="Metrics whose models are loaded at start-up instead of by their first job.")
+    server_args, scorer_argv = parser.parse_known_args()
+
+    evaluator = Evaluator(parse_args(scorer_argv))
+    evaluator.preload(server_args.preload)
+
+    server = ThreadingHTTPServer((server_args.host, server_args.port), handler(evaluator))
+    print(f"Serving evaluation jobs on http://{server_args.host}:{server_args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+
+
+if __name__ == "__main__":
+    main()
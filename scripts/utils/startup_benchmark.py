@@ -0,0 +1,80 @@
+import sys
+import json
+import time
+import argparse
+import subprocess
+
+# What has to stay fast: the command lines of the entry points and the modules without models.
+COMMANDS = [
+    ["-m", "scripts.alignment.alignment_score", "--help"],
+    ["-m", "scripts.text.text_score", "--help"],
+    ["-m", "scripts.diversity.diversity_score", "--help"],
+    ["-m", "scripts.style.style_score", "--help"],
+    ["-m", "scripts.reasoning.reasoning_score", "--help"],
+    ["-m", "scripts.utils.run_metrics", "--help"],
+    ["-m", "scripts.utils.server", "--help"],
+    ["-m", "scripts.utils.merge_shards", "--help"],
+    ["-m", "scripts.utils.manifest", "--help"],
+]
+MODULES = [
+    "scripts.utils.utils",
+    "scripts.utils.backends",
+    "scripts.utils.manifest",
+    "scripts.utils.journal",
+    "scripts.utils.parallel",
+    "scripts.text.text_utils",
+    "scripts.alignment.alignment_score",
+    "scripts.text.text_score",
+    "scripts.diversity.diversity_score",
+    "scripts.style.style_score",
+    "scripts.reasoning.reasoning_score",
+]
+# imported only once a model is built, a result is written or an image is read
+HEAVY_MODULES = ["torch", "torchvision", "transformers", "qwen_vl_utils", "dreamsim", "pandas", "megfile"]
+
+
+def run(argv, repeat):
+    times = []
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        subprocess.run([sys.executable, *argv], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+        times.append(time.perf_counter() - start_time)
+    return min(times)
+
+
+def heavy_imports(module):
+    code = f"import sys, json, {module}; print(json.dumps([name for name in {HEAVY_MODULES!r} if name in sys.modules]))"
+    output = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True).stdout
+    return json.loads(output)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the start-up time of the entry points and of the modules without models.")
+    parser.add_argument("--repeat", type=int, default=5, help="Runs of each command, the fastest one is reported.")
+    parser.add_argument("--budget", type=float, default=1.0, help="Seconds a command may take, exit with an error when one is slower.")
+    args = parser.parse_args()
+
+    baseline = run(["-c", "pass"], args.repeat)
+    print(f"{'python -c pass':60s} {baseline * 1000:7.0f} ms")
+
+    slow = []
+    for argv in COMMANDS:
+        seconds = run(argv, args.repeat)
+        print(f"{' '.join(['python', *argv]):60s} {seconds * 1000:7.0f} ms")
+        if seconds > args.budget:
+            slow.append(" ".join(argv))
+
+    for module in MODULES:
+        seconds = run(["-c", f"import {module}"], args.repeat)
+        heavy = heavy_imports(module)
+        print(f"{'import ' + module:60s} {seconds * 1000:7.0f} ms" + (f"   imports {', '.join(heavy)}" if heavy else ""))
+        if seconds > args.budget or heavy:
+            slow.append(module)
+
+    if slow:
+        print(f"Over the {args.budget:.1f} s budget or importing heavy modules: {', '.join(slow)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+import os
+import time
+import hashlib
+import sqlite3
+import threading
+import numpy as np
+
+
+class TileCache:
+    def __init__(self, cache_dir: str, max_bytes: int = 20 * 1024 ** 3):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+        # the index is shared by the prefetch threads, so every access goes through the lock
+        self.lock = threading.RLock()
+        self.index = sqlite3.connect(os.path.join(cache_dir, "index.sqlite"), timeout=60, check_same_thread=False)
+        self.index.execute("PRAGMA journal_mode=WAL")
+        self.index.execute(
+            "CREATE TABLE IF NOT EXISTS tiles (key TEXT PRIMARY KEY, file TEXT, nbytes INTEGER, last_access REAL)"
+        )
+        # maps a source path to its content hash so that hits never have to fetch the image again
+        self.index.execute(
+            "CREATE TABLE IF NOT EXISTS sources (path TEXT PRIMARY KEY, size INTEGER, mtime REAL, digest TEXT)"
+        )
+        self.index.commit()
+
+    def source(self, image_path):
+        # (content hash, bytes read to compute it or None when the hash was indexed), the bytes are
+        # handed on to the decoder so a cold image is fetched once
+        import megfile
+        stat = megfile.smart_stat(image_path)
+        with self.lock:
+            row = self.index.execute(
+                "SELECT digest FROM sources WHERE path = ? AND size = ? AND mtime = ?",
+                (image_path, stat.size, stat.mtime),
+            ).fetchone()
+        if row is not None:
+            return row[0], None
+
+        with megfile.smart_open(image_path, 'rb') as f:
+            data = f.read()
+        digest = hashlib.sha1(data).hexdigest()
+        with self.lock, self.index:
+            self.index.execute(
+                "INSERT OR REPLACE INTO sources VALUES (?, ?, ?, ?)",
+                (image_path, stat.size, stat.mtime, digest),
+            )
+        return digest, data
+
+    def _get(self, key):
+        with self.lock:
+            row = self.index.execute("SELECT file FROM tiles WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            path = os.path.join(self.cache_dir, row[0])
+            if not os.path.exists(path):
+                with self.index:
+                    self.index.execute("DELETE FROM tiles WHERE key = ?", (key,))
+                return None
+            with self.index:
+                self.index.execute("UPDATE tiles SET last_access = ? WHERE key = ?", (time.time(), key))
+        return np.load(path, mmap_mode='r')
+
+    def _put(self, key, tiles):
+        file_name = f"{key}.npy"
+        path = os.path.join(self.cache_dir, file_name)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        store = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.uint8, shape=tiles.shape)
+        store[:] = tiles
+        store.flush()
+        del store
+        os.replace(tmp_path, path)
+        with self.lock:
+            with self.index:
+                self.index.execute(
+                    "INSERT OR REPLACE INTO tiles VALUES (?, ?, ?, ?)",
+                    (key, file_name, tiles.nbytes, time.time()),
+                )
+            self._evict()
+
+    def _evict(self):
+        total = self.index.execute("SELECT COALESCE(SUM(nbytes), 0) FROM tiles").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        for key, file_name, nbytes in self.index.execute(
+            "SELECT key, file, nbytes FROM tiles ORDER BY last_access"
+        ).fetchall():
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.cache_dir, file_name))
+            except FileNotFoundError:
+                pass
+            with self.index:
+                self.index.execute("DELETE FROM tiles WHERE key = ?", (key,))
+            total -= nbytes
+
+    def load(self, image_path, grid_size, decode_fn, min_tile_side=None, source=None):
+        import megfile
+        digest, data = source or self.source(image_path)
+        key = f"{digest}_{grid_size[0]}x{grid_size[1]}"
+        if min_tile_side:
+            key += f"_min{min_tile_side}"
+
+        tiles = self._get(key)
+        if tiles is not None:
+            return tiles
+
+        if data is None:
+            with megfile.smart_open(image_path, 'rb') as f:
+                data = f.read()
+        tiles = decode_fn(data, grid_size, min_tile_side)
+        self._put(key, tiles)
+        return tiles
+
+    def close(self):
+        self.index.close()
+
+
+def build_tile_cache(args):
+    if not args.tile_cache_dir:
+        return None
+    return TileCache(args.tile_cache_dir, int(args.tile_cache_size_gb * 1024 ** 3))
@@ -1,67 +1,168 @@
-import os
-import stat
-import megfile
+import io
 import argparse
-import pandas as pd
+import numpy as np
 from PIL import Image
 Image.MAX_IMAGE_PIXELS = None
 
-def parse_args():
+def parse_args(argv=None):
     parser = argparse.ArgumentParser(description="Run alignment score evaluation.")
     parser.add_argument("--mode", type=str, default="EN", help="Choose language mode.")
     parser.add_argument("--image_dirname", type=str, default="images", help="Directory containing images.")
     parser.add_argument("--model_names", type=str, nargs="+", default=["gpt-4o"], help="List of model names.")
     parser.add_argument("--image_grid", type=str, nargs="+", default=["2,2"], help="List of image grids.")
     parser.add_argument("--class_items", type=str, nargs="+", default=["anime", "human", "object"], help="List of class items.")
-    return parser.parse_args()
+    parser.add_argument("--backend", type=str, default="hf", choices=["hf", "mock"], help="Inference backend, mock gives deterministic CPU outputs without any checkpoint.")
+    parser.add_argument("--device", type=str, default="cuda", help="Device the models run on.")
+    parser.add_argument("--answer_cache", type=str, default=None, help="SQLite file caching VLM answers by tile, message, generation params and checkpoint.")
+    parser.add_argument("--answer_cache_size", type=int, default=2_000_000, help="Maximum number of answers kept in --answer_cache, least recently used ones are evicted.")
+    parser.add_argument("--batch_size", type=int, default=16, help="Number of (tile, question) pairs sent to the VLM in one batch.")
+    parser.add_argument("--token_budget", type=int, default=None, help="Cap VLM batches by padded prompt plus generated tokens instead of --batch_size, requests of similar length are batched together.")
+    parser.add_argument("--ocr_batch_prompts", type=int, default=8, help="Number of prompts whose tiles are read in one OCR call, so --token_budget batches them together (text only).")
+    parser.add_argument("--cross_model_batching", action="store_true", help="Ask each alignment question about the images of all models in one batch.")
+    parser.add_argument("--semantic_mode", type=str, default="generate", choices=["generate", "logits"], help="Answer alignment questions by decoding or by comparing Yes/No logits.")
+    parser.add_argument("--soft_alignment", action="store_true", help="Average the probability of 'Yes' instead of the binary answer (logits mode only).")
+    parser.add_argument("--reuse_vision", action="store_true", help="Encode each tile once and reuse its vision features for every question (logits mode only).")
+    parser.add_argument("--lazy_dependencies", action="store_true", help="Only ask alignment questions whose parent questions were answered 'Yes'.")
+    parser.add_argument("--black_threshold", type=int, default=0, help="Tiles whose brightest channel value is at most this are treated as black.")
+    parser.add_argument("--black_check_size", type=int, default=None, help="Check black tiles on a reduced copy about this many pixels per tile side.")
+    parser.add_argument("--tile_cache_dir", type=str, default=None, help="Directory of the decoded tile cache shared by all metrics.")
+    parser.add_argument("--tile_cache_size_gb", type=float, default=20, help="Size limit of the decoded tile cache in GB.")
+    parser.add_argument("--reduced_decode", action="store_true", help="Decode grids only at the resolution the metric's encoder needs.")
+    parser.add_argument("--num_io_workers", type=int, default=4, help="Number of threads fetching and decoding images ahead of inference.")
+    parser.add_argument("--num_preprocess_workers", type=int, default=0, help="Number of processes decoding and preprocessing tiles for the style encoders, 0 keeps it in the main process.")
+    parser.add_argument("--manifest", type=str, default=None, help="Compiled benchmark manifest, scripts/manifest_<mode>.pkl by default and compiled on the fly when missing.")
+    parser.add_argument("--journal", type=str, default=None, help="Append-only JSONL file recording each finished (metric, model, prompt) result.")
+    parser.add_argument("--resume", action="store_true", help="Reuse the results recorded in --journal whose image, grid and scoring config are unchanged.")
+    parser.add_argument("--workers", type=int, default=1, help="Number of worker processes, each scoring a shard of the prompts on its own GPU.")
+    parser.add_argument("--shard_index", type=int, default=0, help="Index of the shard of the prompts scored by this run, from 0 to --num_shards - 1.")
+    parser.add_argument("--num_shards", type=int, default=1, help="Number of runs one evaluation is split into, merged afterwards by scripts.utils.merge_shards.")
+    parser.add_argument("--partial_dir", type=str, default="results/partials", help="Directory of the partial results of each shard.")
+    # set by --workers for each of its worker processes
+    parser.add_argument("--partial_file", type=str, default=None, help=argparse.SUPPRESS)
+    parser.add_argument("--prefetch", type=int, default=8, help="Number of images fetched ahead of the one being scored.")
+    return parser.parse_args(argv)
 
-def is_black_image(image):
-    pixels = image.load()  
-    for i in range(image.width):
-        for j in range(image.height):
-            if pixels[i, j] != (0, 0, 0):
-                return False
-    return True
+def is_black_image(image, threshold=0):
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+    return all(band_max <= threshold for _, band_max in image.getextrema())
 
-def split_mxn_grid(image_path, grid_size, cache_dir):
-    with megfile.smart_open(image_path, 'rb') as f:
-        grid_image = Image.open(f)
+def black_tile_mask(grid_image, grid_size, threshold=0, check_size=None):
+    width, height = grid_image.size
 
-        width, height = grid_image.size
+    individual_width = width // grid_size[0]
+    individual_height = height // grid_size[1]
 
-        individual_width = width // grid_size[0]
-        individual_height = height // grid_size[1]
+    if grid_image.mode != "RGB":
+        grid_image = grid_image.convert("RGB")
 
-        image_list = []
+    # check on a box-reduced copy so that each tile is about check_size pixels wide
+    factor = 1
+    if check_size:
+        factor = max(1, min(individual_width, individual_height) // check_size)
+    if factor > 1:
+        grid_image = grid_image.reduce(factor)
+    pixels = np.asarray(grid_image)
 
-        for i in range(grid_size[1]):
-            for j in range(grid_size[0]):
-                box = (
-                    j * individual_width,      
-                    i * individual_height,     
-                    (j + 1) * individual_width,  
-                    (i + 1) * individual_height  
-                )
+    mask = np.zeros((grid_size[1], grid_size[0]), dtype=bool)
+    for i in range(grid_size[1]):
+        for j in range(grid_size[0]):
+            # only reduced pixels fully inside the tile, so neighbours never leak in
+            top = -(-i * individual_height // factor)
+            bottom = max((i + 1) * individual_height // factor, top + 1)
+            left = -(-j * individual_width // factor)
+            right = max((j + 1) * individual_width // factor, left + 1)
+            mask[i, j] = pixels[top:bottom, left:right].max() <= threshold
+    return mask
 
-                individual_image = grid_image.crop(box)
+def open_image(image):
+    if isinstance(image, Image.Image):
+        return image
+    return Image.open(image)
 
-                if is_black_image(individual_image):
-                    print(f"Detected a black image at position ({i},{j}) in {image_path}")
-                else:
-                    image_list.append(individual_image)
+def decode_grid(fp, grid_size, min_tile_side=None):
+    grid_image = Image.open(fp)
+    if min_tile_side:
+        # JPEG decodes straight to a 1/2, 1/4 or 1/8 scale no smaller than requested
+        grid_image.draft("RGB", (grid_size[0] * min_tile_side, grid_size[1] * min_tile_side))
+    grid_image.load()
 
-    image_path_list = []
-    for i, image in enumerate(image_list):
-        image_path = os.path.join(cache_dir, f"{i}.jpg")
-        image.save(image_path)
-        image_path_list.append(image_path)
+    if min_tile_side:
+        factor = min(grid_image.width // grid_size[0], grid_image.height // grid_size[1]) // min_tile_side
+        if factor > 1:
+            grid_image = grid_image.reduce(factor)
+    return grid_image
 
-    return image_path_list
+def decode_tile_array(data, grid_size, min_tile_side=None):
+    grid_image = decode_grid(io.BytesIO(data), grid_size, min_tile_side).convert("RGB")
+
+    width, height = grid_image.size
+
+    individual_width = width // grid_size[0]
+    individual_height = height // grid_size[1]
+
+    pixels = np.asarray(grid_image)[:grid_size[1] * individual_height, :grid_size[0] * individual_width]
+    tiles = pixels.reshape(grid_size[1], individual_height, grid_size[0], individual_width, 3)
+    return np.ascontiguousarray(tiles.transpose(0, 2, 1, 3, 4)).reshape(-1, individual_height, individual_width, 3)
+
+def split_cached_tiles(image_path, grid_size, tile_cache, black_threshold=0, black_check_size=None, min_tile_side=None, source=None):
+    tiles = tile_cache.load(image_path, grid_size, decode_tile_array, min_tile_side, source)
+    if black_check_size:
+        # the tiles laid out as their grid again, so the reduced check sees the same pixels as without the cache
+        _, individual_height, individual_width, _ = tiles.shape
+        pixels = tiles.reshape(grid_size[1], grid_size[0], individual_height, individual_width, 3).transpose(0, 2, 1, 3, 4)
+        grid_image = Image.fromarray(np.ascontiguousarray(pixels).reshape(grid_size[1] * individual_height, grid_size[0] * individual_width, 3))
+        black_mask = black_tile_mask(grid_image, grid_size, black_threshold, black_check_size).reshape(-1)
+    else:
+        black_mask = tiles.reshape(len(tiles), -1).max(axis=1) <= black_threshold
+
+    image_list = []
+    for idx, tile in enumerate(tiles):
+        if black_mask[idx]:
+            i, j = divmod(idx, grid_size[0])
+            print(f"Detected a black image at position ({i},{j}) in {image_path}")
+        else:
+            image_list.append(Image.fromarray(tile))
+
+    return image_list
+
+def split_mxn_tiles(image_path, grid_size, black_threshold=0, black_check_size=None, tile_cache=None, min_tile_side=None, source=None):
+    # source is the (content hash, bytes or None) of the image when the caller already fetched it
+    import megfile
+    if tile_cache is not None:
+        return split_cached_tiles(image_path, grid_size, tile_cache, black_threshold, black_check_size, min_tile_side, source)
+
+    if source is not None and source[1] is not None:
+        grid_image = decode_grid(io.BytesIO(source[1]), grid_size, min_tile_side)
+    else:
+        with megfile.smart_open(image_path, 'rb') as f:
+            grid_image = decode_grid(f, grid_size, min_tile_side)
+
+    width, height = grid_image.size
+
+    individual_width = width // grid_size[0]
+    individual_height = height // grid_size[1]
+
+    black_mask = black_tile_mask(grid_image, grid_size, black_threshold, black_check_size)
+
+    image_list = []
+
+    for i in range(grid_size[1]):
+        for j in range(grid_size[0]):
+            if black_mask[i, j]:
+                print(f"Detected a black image at position ({i},{j}) in {image_path}")
+                continue
+
+            box = (
+                j * individual_width,      
+                i * individual_height,     
+                (j + 1) * individual_width,  
+                (i + 1) * individual_height  
+            )
+            image_list.append(grid_image.crop(box))
+
+    return image_list
 
 def save2csv(df, csv_path):
     df.to_csv(csv_path)
     print(f"Results saved to {csv_path}")
-
-def on_rm_error(func, path, exc_info):
-    os.chmod(path, stat.S_IWRITE)
-    func(path)
@@ -0,0 +1,65 @@
+import numpy as np
+from multiprocessing import get_context
+from multiprocessing.shared_memory import SharedMemory
+from concurrent.futures import ProcessPoolExecutor
+from scripts.utils.loader import tile_loader
+from scripts.utils.tile_cache import build_tile_cache
+
+_load_tiles = None
+_preprocessors = None
+
+
+def _init_worker(args, min_tile_side, preprocess_builders):
+    global _load_tiles, _preprocessors
+    import torch
+    # every worker is one core, the pool size decides how many are used
+    torch.set_num_threads(1)
+    _load_tiles = tile_loader(args, build_tile_cache(args), min_tile_side)
+    _preprocessors = {name: build() for name, build in preprocess_builders.items()}
+
+
+def _preprocess_grid(image_path, img_grid, source=None):
+    tiles = _load_tiles(image_path, img_grid, source)
+    if len(tiles) == 0:
+        return {}
+
+    handles = {}
+    for name, preprocess in _preprocessors.items():
+        batch = np.stack([np.asarray(preprocess(tile.convert('RGB')), dtype=np.float32) for tile in tiles])
+        shm = SharedMemory(create=True, size=batch.nbytes)
+        np.ndarray(batch.shape, dtype=batch.dtype, buffer=shm.buf)[:] = batch
+        handles[name] = (shm.name, batch.shape)
+        shm.close()
+    return handles
+
+
+def receive_tensors(handles, device="cpu"):
+    import torch
+    tensors = {}
+    for name, (shm_name, shape) in handles.items():
+        shm = SharedMemory(name=shm_name)
+        try:
+            pixels = torch.from_numpy(np.ndarray(shape, dtype=np.float32, buffer=shm.buf))
+            # a single copy straight from the shared block to the inference device
+            tensors[name] = pixels.to(device, copy=True)
+            del pixels
+        finally:
+            shm.close()
+            shm.unlink()
+    return tensors
+
+
+class PreprocessPool:
+    def __init__(self, args, preprocess_builders: dict, num_workers: int, min_tile_side=None):
+        self.executor = ProcessPoolExecutor(
+            max_workers=num_workers,
+            mp_context=get_context("spawn"),
+            initializer=_init_worker,
+            initargs=(args, min_tile_side, preprocess_builders),
+        )
+
+    def load(self, image_path, img_grid, source=None):
+        return self.executor.submit(_preprocess_grid, image_path, img_grid, source).result()
+
+    def close(self):
+        self.executor.shutdown()
@@ -0,0 +1,32 @@
+import os
+import sys
+import numpy as np
+import pytest
+from PIL import Image
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# the scripts are run from the repository root, as in run_overall.sh
+sys.path.insert(0, ROOT)
+
+from scripts.utils.utils import parse_args
+
+
+def mock_args(*argv):
+    return parse_args(["--backend", "mock", "--device", "cpu", *argv])
+
+
+def random_grid(seed, grid=(2, 2), tile_size=32):
+    # one colour per tile plus noise, so the mock VLM gives a mix of answers
+    rng = np.random.RandomState(seed)
+    pixels = np.zeros((grid[1] * tile_size, grid[0] * tile_size, 3), dtype=np.uint8)
+    for i in range(grid[1]):
+        for j in range(grid[0]):
+            tile = rng.randint(20, 256, size=3) + rng.randint(-20, 20, size=(tile_size, tile_size, 3))
+            pixels[i * tile_size:(i + 1) * tile_size, j * tile_size:(j + 1) * tile_size] = np.clip(tile, 0, 255)
+    return Image.fromarray(pixels)
+
+
+@pytest.fixture
+def repo_root(monkeypatch):
+    monkeypatch.chdir(ROOT)
+    return ROOT
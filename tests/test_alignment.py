@@ -0,0 +1,150 @@
+from copy import deepcopy
+import numpy as np
+import pytest
+from PIL import Image
+from conftest import mock_args, random_grid
+from scripts.utils.backends import build_backend
+from scripts.utils.tile_cache import build_tile_cache
+from scripts.utils.utils import split_mxn_tiles
+from scripts.alignment.alignment_score import alignment_score, alignment_scores, compile_questions, filter_and_average
+
+
+def baseline_alignment_score(inferencer, split_img_list, questions, dependencies):
+    # the loop the scores were computed with before batching, filtering and averaging were vectorized
+    score = {}
+    for id, question in questions.items():
+        batch_answer = inferencer.infer_semantic(split_img_list, question)
+        score[id] = [float(ans == "Yes") for ans in batch_answer]
+
+    filter_score = deepcopy(score)
+    for img_idx in range(len(split_img_list)):
+        for id, parent_ids in dependencies.items():
+            any_parent_answered_no = False
+            for parent_id in parent_ids:
+                if parent_id == 0:
+                    continue
+                if score[parent_id][img_idx] == 0:
+                    any_parent_answered_no = True
+                    break
+            if any_parent_answered_no:
+                filter_score[id][img_idx] = 0
+
+    sum_of_filter_score = [0] * len(split_img_list)
+    for question_id in range(len(filter_score)):
+        for img_idx in range(len(split_img_list)):
+            sum_of_filter_score[img_idx] += filter_score[question_id + 1][img_idx]
+
+    sum_of_filter_score = [img_score / len(filter_score) for img_score in sum_of_filter_score]
+    return sum(sum_of_filter_score) / len(sum_of_filter_score)
+
+
+def random_questions(seed, num_questions):
+    # questions 1..n, each depending on [0] or on some earlier questions
+    rng = np.random.RandomState(seed)
+    questions = {id: f"Is there thing {seed}-{id} in the image?" for id in range(1, num_questions + 1)}
+    dependencies = {}
+    for id in questions:
+        parents = [parent_id for parent_id in range(1, id) if rng.rand() < 0.3]
+        dependencies[id] = parents or [0]
+    return questions, dependencies
+
+
+def random_tiles(seed, grid=(2, 2)):
+    grid_image = random_grid(seed, grid)
+    return [grid_image.crop((j * 32, i * 32, (j + 1) * 32, (i + 1) * 32)) for i in range(grid[1]) for j in range(grid[0])]
+
+
+FLAGS = [
+    [],
+    ["--lazy_dependencies"],
+    ["--batch_size", "1"],
+    ["--token_budget", "2000"],
+    ["--semantic_mode", "logits"],
+    ["--semantic_mode", "logits", "--reuse_vision", "--lazy_dependencies"],
+]
+
+
+@pytest.mark.parametrize("flags", FLAGS)
+def test_alignment_score_matches_baseline(flags):
+    args = mock_args(*flags)
+    inferencer = build_backend(args, "vlm")
+    reference = build_backend(mock_args(), "vlm")
+    for seed in range(6):
+        questions, dependencies = random_questions(seed, 3 + seed)
+        tiles = random_tiles(seed, [(2, 2), (1, 4), (3, 1)][seed % 3])
+        expected = baseline_alignment_score(reference, tiles, questions, dependencies)
+        assert alignment_score(inferencer, tiles, questions, dependencies, args) == expected
+
+
+@pytest.mark.parametrize("flags", FLAGS)
+def test_cross_model_batching_matches_baseline(flags):
+    args = mock_args("--cross_model_batching", *flags)
+    inferencer = build_backend(args, "vlm")
+    questions, dependencies = random_questions(7, 8)
+    tiles_per_model = {"m1": random_tiles(1), "m2": random_tiles(2, (1, 4)), "missing": None, "black": []}
+    scores = alignment_scores(inferencer, tiles_per_model, questions, dependencies, args)
+
+    reference = build_backend(mock_args(), "vlm")
+    assert scores["missing"] is None and scores["black"] is None
+    for model_name in ["m1", "m2"]:
+        assert scores[model_name] == baseline_alignment_score(reference, tiles_per_model[model_name], questions, dependencies)
+
+
+def test_lazy_dependencies_skip_blocked_questions():
+    asked = []
+    inferencer = build_backend(mock_args(), "vlm")
+    generate = inferencer.generate
+    inferencer.generate = lambda messages, max_new_tokens=128: asked.extend(messages) or generate(messages, max_new_tokens)
+
+    questions, dependencies = random_questions(3, 10)
+    tiles = random_tiles(3)
+    alignment_score(inferencer, tiles, questions, dependencies, mock_args("--lazy_dependencies"))
+    lazy = len(asked)
+    asked.clear()
+    alignment_score(inferencer, tiles, questions, dependencies, mock_args())
+    assert lazy < len(asked) == len(questions) * len(tiles)
+
+
+def test_filter_and_average_pads_instances():
+    # instances with different numbers of questions and tiles, filtered in one call
+    rng = np.random.RandomState(0)
+    answers, parents, expected = [], [], []
+    for num_questions, num_tiles in [(3, 4), (7, 2), (1, 1), (5, 9)]:
+        questions, dependencies = random_questions(num_questions, num_questions)
+        _, parent_matrix = compile_questions(questions, dependencies)
+        instance = rng.randint(0, 2, size=(num_questions, num_tiles)).astype(float)
+        answers.append(instance)
+        parents.append(parent_matrix)
+
+        score = {id: list(instance[id - 1]) for id in questions}
+        filtered = deepcopy(score)
+        for img_idx in range(num_tiles):
+            for id, parent_ids in dependencies.items():
+                if any(parent_id != 0 and score[parent_id][img_idx] == 0 for parent_id in parent_ids):
+                    filtered[id][img_idx] = 0
+        tile_scores = [sum(filtered[id][img_idx] for id in questions) / num_questions for img_idx in range(num_tiles)]
+        expected.append(sum(tile_scores) / num_tiles)
+
+    assert filter_and_average(answers, parents) == expected
+
+
+def test_split_mxn_tiles_keeps_pixels(tmp_path):
+    grid_image = random_grid(5)
+    grid_image.save(tmp_path / "000.png")
+    tiles = split_mxn_tiles(str(tmp_path / "000.png"), (2, 2))
+    assert [np.asarray(tile).tolist() for tile in tiles] == [np.asarray(tile).tolist() for tile in random_tiles(5)]
+
+
+@pytest.mark.parametrize("black_check_size", [None, 4])
+def test_tile_cache_checks_black_tiles_as_without_it(tmp_path, black_check_size):
+    # a faint pixel in a black tile, lost in the reduced check
+    pixels = np.asarray(random_grid(6)).copy()
+    pixels[:32, :32] = 0
+    pixels[5, 7] = 40
+    Image.fromarray(pixels).save(tmp_path / "000.png")
+    tile_cache = build_tile_cache(mock_args("--tile_cache_dir", str(tmp_path / "tiles")))
+
+    tiles = split_mxn_tiles(str(tmp_path / "000.png"), (2, 2), 10, black_check_size)
+    cached = split_mxn_tiles(str(tmp_path / "000.png"), (2, 2), 10, black_check_size, tile_cache)
+    assert len(tiles) == (3 if black_check_size else 4)
+    assert [np.asarray(tile).tolist() for tile in cached] == [np.asarray(tile).tolist() for tile in tiles]
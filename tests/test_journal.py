@@ -0,0 +1,114 @@
+import os
+import json
+import megfile
+import pytest
+from conftest import mock_args, random_grid
+from scripts.utils.journal import build_journal
+from scripts.utils.manifest import Manifest
+from scripts.utils.mock_backend import MockVLM
+from scripts.utils.parallel import Sharding
+from scripts.alignment import alignment_score
+
+QUESTIONS = {1: "Is there a cat?", 2: "Is the cat black?", 3: "Is there a dog?", 4: "Is the dog running?"}
+DEPENDENCIES = {1: [0], 2: [1], 3: [0], 4: [3]}
+IDS = ["000", "001", "002"]
+
+
+@pytest.fixture
+def manifest():
+    records = {("anime", id): {"question": dict(QUESTIONS), "dependency": dict(DEPENDENCIES)} for id in IDS}
+    return Manifest("EN", records, {"anime": list(IDS)}, {}, {})
+
+
+@pytest.fixture
+def image_dir(tmp_path):
+    for model_id, model_name in enumerate(["m1", "m2"]):
+        os.makedirs(tmp_path / "images" / "anime" / model_name)
+        for idx, id in enumerate(IDS):
+            random_grid(10 * model_id + idx).save(tmp_path / "images" / "anime" / model_name / f"{id}.png")
+    return tmp_path / "images"
+
+
+@pytest.fixture
+def asked(monkeypatch):
+    # every message the mock VLM decodes
+    messages = []
+    generate = MockVLM.generate
+
+    def counting_generate(self, batch, max_new_tokens=128):
+        messages.extend(batch)
+        return generate(self, batch, max_new_tokens)
+    monkeypatch.setattr(MockVLM, "generate", counting_generate)
+    return messages
+
+
+def score(manifest, image_dir, journal, *flags):
+    args = mock_args(
+        "--image_dirname", str(image_dir), "--class_items", "anime", "--model_names", "m1", "m2",
+        "--image_grid", "2,2", "2,2", "--journal", str(journal), *flags,
+    )
+    return alignment_score.score(args, manifest, Sharding(manifest))
+
+
+@pytest.mark.parametrize("flags", [[], ["--tile_cache_dir"], ["--cross_model_batching"]])
+def test_resume_reuses_unchanged_results(tmp_path, manifest, image_dir, asked, flags):
+    if flags == ["--tile_cache_dir"]:
+        flags = flags + [str(tmp_path / "tiles")]
+    journal = tmp_path / "journal.jsonl"
+    results = score(manifest, image_dir, journal, *flags)
+    assert len(asked) == len(IDS) * 2 * len(QUESTIONS) * 4
+    with open(journal) as f:
+        assert len(f.readlines()) == len(IDS) * 2
+
+    asked.clear()
+    assert score(manifest, image_dir, journal, "--resume", *flags) == results
+    assert asked == []
+
+    # only the prompt whose image changed is scored again
+    random_grid(99).save(image_dir / "anime" / "m2" / "001.png")
+    resumed = score(manifest, image_dir, journal, "--resume", *flags)
+    assert len(asked) == len(QUESTIONS) * 4
+    assert {key: result for key, result in resumed.items() if key != ("m2", "anime_001")} == {
+        key: result for key, result in results.items() if key != ("m2", "anime_001")
+    }
+    with open(journal) as f:
+        assert json.loads(f.readlines()[-1])["prompt"] == "anime_001"
+
+
+@pytest.mark.parametrize("flags", [["--black_threshold", "5"], ["--semantic_mode", "logits"]])
+def test_resume_scores_again_after_a_config_change(tmp_path, manifest, image_dir, asked, flags):
+    journal = tmp_path / "journal.jsonl"
+    score(manifest, image_dir, journal)
+    asked.clear()
+    score(manifest, image_dir, journal, "--resume", *flags)
+    if "--semantic_mode" in flags:
+        # logits mode answers through yes_no, so no message is decoded but every prompt is written again
+        assert asked == []
+    else:
+        assert len(asked) == len(IDS) * 2 * len(QUESTIONS) * 4
+    with open(journal) as f:
+        assert len(f.readlines()) == len(IDS) * 4
+
+
+def test_resume_ignores_results_of_another_backend(tmp_path, manifest, image_dir):
+    journal_path = tmp_path / "journal.jsonl"
+    score(manifest, image_dir, journal_path)
+
+    image_path = str(image_dir / "anime" / "m1" / "000.png")
+    for backend, model_id, done in [("mock", "mock", True), ("hf", "Qwen/Qwen2.5-VL-7B-Instruct", False)]:
+        args = mock_args("--backend", backend, "--journal", str(journal_path), "--resume")
+        journal = build_journal(args, "alignment", model_id=model_id)
+        assert journal.done("m1", "anime_000", journal.inputs(journal.source(image_path), (2, 2))) == done
+        journal.close()
+
+
+@pytest.mark.parametrize("flags", [[], ["--tile_cache_dir"]])
+def test_journal_fetches_each_image_once(tmp_path, manifest, image_dir, monkeypatch, flags):
+    if flags:
+        flags = flags + [str(tmp_path / "tiles")]
+    opened = []
+    smart_open = megfile.smart_open
+    monkeypatch.setattr(megfile, "smart_open", lambda path, *args, **kwargs: opened.append(path) or smart_open(path, *args, **kwargs))
+
+    score(manifest, image_dir, tmp_path / "journal.jsonl", *flags)
+    assert sorted(opened) == sorted(set(opened)) and len(opened) == len(IDS) * 2
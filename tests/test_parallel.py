@@ -0,0 +1,97 @@
+import os
+import sys
+import subprocess
+import pytest
+from conftest import mock_args, random_grid
+from scripts.utils.manifest import load_manifest
+from scripts.utils.parallel import Sharding, load_partial, merge_partials, partial_path, save_partial, worker_devices
+
+
+@pytest.fixture
+def manifest(repo_root):
+    return load_manifest("EN")
+
+
+def shard_partials(tmp_path, manifest, num_shards, args=None):
+    # a partial of every shard whose results are the prompts it owns
+    paths = []
+    for shard_index in range(num_shards):
+        shard_args = args or mock_args("--shard_index", str(shard_index), "--num_shards", str(num_shards))
+        shard_args.shard_index = shard_index
+        sharding = Sharding(manifest, shard_index, num_shards)
+        results = {("m1", f"{category}_{id}"): len(id) for category, id in manifest.records if sharding.owns(category, id)}
+        path = partial_path(str(tmp_path), "alignment", "EN", shard_index, num_shards)
+        save_partial(path, shard_args, "alignment", manifest, results)
+        paths.append(path)
+    return [load_partial(path) for path in paths]
+
+
+@pytest.mark.parametrize("num_shards", [1, 2, 3, 7])
+def test_shards_partition_the_manifest(manifest, num_shards):
+    owners = {key: [shard_index for shard_index in range(num_shards) if Sharding(manifest, shard_index, num_shards).owns(*key)] for key in manifest.records}
+    assert all(len(shard_indices) == 1 for shard_indices in owners.values())
+    sizes = [sum(shard_indices == [shard_index] for shard_indices in owners.values()) for shard_index in range(num_shards)]
+    assert max(sizes) - min(sizes) <= 1
+
+
+def test_merge_partials(tmp_path, manifest):
+    partials = shard_partials(tmp_path, manifest, 3)
+    results = merge_partials(partials)
+    assert results == {("m1", f"{category}_{id}"): len(id) for category, id in manifest.records}
+
+
+def test_merge_partials_rejects_missing_and_duplicate_shards(tmp_path, manifest):
+    partials = shard_partials(tmp_path, manifest, 3)
+    with pytest.raises(ValueError, match="missing"):
+        merge_partials(partials[:2])
+    with pytest.raises(ValueError, match="more than once"):
+        merge_partials(partials + [partials[1]])
+
+
+def test_merge_partials_rejects_different_settings(tmp_path, manifest):
+    partials = shard_partials(tmp_path, manifest, 2)
+    other = shard_partials(tmp_path / "hf", manifest, 2, mock_args("--backend", "hf", "--num_shards", "2"))
+    with pytest.raises(ValueError):
+        merge_partials([partials[0], other[1]])
+
+
+def test_worker_devices_give_each_worker_its_own_gpu(monkeypatch):
+    monkeypatch.setenv("CUDA_VISIBLE_DEVICES", "2,5,7")
+    assert worker_devices(2) == ["2", "5"]
+    assert worker_devices(3, "cuda:0") == ["2", "5", "7"]
+    with pytest.raises(ValueError, match=r"visible ones are \(2,5,7\)"):
+        worker_devices(4)
+    monkeypatch.setenv("CUDA_VISIBLE_DEVICES", "0")
+    with pytest.raises(ValueError, match=r"visible ones are \(0\)"):
+        worker_devices(2)
+    assert worker_devices(2, "cpu") == [None, None]
+
+
+def run_alignment(repo_root, image_dir, partial_file, *flags):
+    command = [
+        sys.executable, "-m", "scripts.alignment.alignment_score",
+        "--backend", "mock", "--device", "cpu", "--image_dirname", str(image_dir), "--class_items", "anime",
+        "--model_names", "m1", "m2", "--image_grid", "2,2", "1,4", *flags,
+    ]
+    if partial_file is not None:
+        command += ["--partial_file", str(partial_file)]
+    subprocess.run(command, cwd=repo_root, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def test_workers_and_shards_match_a_single_run(tmp_path, repo_root, manifest):
+    image_dir = tmp_path / "images"
+    for model_id, (model_name, grid) in enumerate([("m1", (2, 2)), ("m2", (1, 4))]):
+        os.makedirs(image_dir / "anime" / model_name)
+        for idx, id in enumerate(list(manifest.prompts("anime", "question"))[:6]):
+            random_grid(10 * model_id + idx, grid).save(image_dir / "anime" / model_name / f"{id}.png")
+
+    run_alignment(repo_root, image_dir, tmp_path / "single.json")
+    run_alignment(repo_root, image_dir, tmp_path / "workers.json", "--workers", "2")
+    for shard_index in range(3):
+        run_alignment(repo_root, image_dir, None, "--shard_index", str(shard_index), "--num_shards", "3", "--partial_dir", str(tmp_path / "shards"))
+
+    single = load_partial(tmp_path / "single.json")["results"]
+    assert sum(result is not None for result in single.values()) == 12
+    assert load_partial(tmp_path / "workers.json")["results"] == single
+    shards = [load_partial(partial_path(str(tmp_path / "shards"), "alignment", "EN", shard_index, 3)) for shard_index in range(3)]
+    assert merge_partials(shards) == single
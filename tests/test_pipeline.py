@@ -0,0 +1,63 @@
+import gc
+import time
+import logging
+import threading
+import pytest
+from scripts.utils.pipeline import Pipeline, Stage
+
+pytestmark = pytest.mark.filterwarnings("error::pytest.PytestUnraisableExceptionWarning")
+
+
+def double(item, value):
+    return value * 2
+
+
+def pipeline(calls, fail_at=None):
+    def load(item):
+        calls.append(item)
+        if item == fail_at:
+            raise ValueError(f"cannot load {item}")
+        return item + 1
+    # instant stages leave the executors idle, so nothing delays the shutdown of the event loop
+    return Pipeline("test", [Stage("load", load, "io", 3), Stage("double", double, "model")], queue_size=2)
+
+
+@pytest.fixture
+def clean_shutdown(caplog):
+    # every thread of a pipeline is joined and asyncio reports no task left pending
+    threads = threading.active_count()
+    yield
+    gc.collect()
+    assert threading.active_count() == threads
+    assert [record.getMessage() for record in caplog.records if record.name == "asyncio" and record.levelno >= logging.ERROR] == []
+
+
+def test_outputs_follow_every_stage(clean_shutdown):
+    outputs = dict(pipeline([]).run(range(20)))
+    assert outputs == {item: (item + 1) * 2 for item in range(20)}
+
+
+@pytest.mark.parametrize("repeat", range(5))
+def test_early_exit_stops_every_stage(clean_shutdown, repeat):
+    calls = []
+    for count, (item, output) in enumerate(pipeline(calls).run(range(100))):
+        if count == 3:
+            break
+    # only the items already queued were loaded, nothing runs once the loop is left
+    loaded = len(calls)
+    time.sleep(0.05)
+    assert loaded == len(calls) < 100
+
+
+def test_error_in_the_caller_stops_every_stage(clean_shutdown):
+    with pytest.raises(KeyError):
+        for item, output in pipeline([]).run(range(100)):
+            raise KeyError(item)
+
+
+def test_failing_stage_raises_in_the_caller(clean_shutdown):
+    calls = []
+    with pytest.raises(ValueError, match="cannot load 5"):
+        for item, output in pipeline(calls, fail_at=5).run(range(100)):
+            pass
+    assert len(calls) < 100
@@ -0,0 +1,42 @@
+import json
+import threading
+import urllib.request
+import urllib.error
+from http.server import ThreadingHTTPServer
+import pytest
+from conftest import mock_args
+from scripts.utils import backends
+from scripts.utils.server import Evaluator, handler
+
+
+@pytest.fixture
+def server(monkeypatch):
+    # the resident backends of the evaluator are dropped with the test
+    monkeypatch.setattr(backends, "resident_backends", None)
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler(Evaluator(mock_args("--backend", "mock", "--device", "cpu"))))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+    server.server_close()
+    thread.join()
+
+
+def post(url, job):
+    request = urllib.request.Request(f"{url}/score", data=json.dumps(job).encode("utf-8"), method="POST")
+    try:
+        with urllib.request.urlopen(request) as response:
+            return response.status, json.loads(response.read())
+    except urllib.error.HTTPError as e:
+        return e.code, json.loads(e.read())
+
+
+@pytest.mark.parametrize("job", [
+    {"model_names": ["m1", "m2"], "image_grid": ["2,2"]},
+    {"model_names": ["m1", "m2"]},
+    {"model_names": "m1", "image_grid": "2,2"},
+    {"model_names": ["m1"], "image_grid": ["two"]},
+])
+def test_job_with_bad_models_or_grids_is_rejected(server, job):
+    status, body = post(server, {"metrics": ["text"], **job})
+    assert status == 400 and "image_grid" in body["error"]
@@ -0,0 +1,26 @@
+import pytest
+from conftest import mock_args, random_grid
+from scripts.utils.backends import build_backend
+from scripts.text.text_score import ocr_prompt_scores
+
+
+def random_prompts():
+    # tiles of prompts with short and long ground truths, one without any usable image
+    prompts = []
+    for seed in range(5):
+        grid_image = random_grid(seed, (2, 2))
+        tiles = [grid_image.crop((j * 32, i * 32, (j + 1) * 32, (i + 1) * 32)) for i in range(2) for j in range(2)]
+        prompts.append((tiles, " ".join(["word"] * (10 + 30 * seed))))
+    prompts.insert(2, (None, "missing image"))
+    return prompts
+
+
+@pytest.mark.parametrize("flags", [[], ["--token_budget", "3000"]])
+def test_ocr_of_several_prompts_matches_one_prompt_at_a_time(flags):
+    prompts = random_prompts()
+    reference = build_backend(mock_args(), "vlm")
+    expected = [ocr_prompt_scores(reference, [prompt])[0] for prompt in prompts]
+
+    influencer = build_backend(mock_args(*flags), "vlm")
+    assert ocr_prompt_scores(influencer, prompts) == expected
+    assert expected[2] is None and all(len(tile_scores) == 4 for tile_scores in expected[:2] + expected[3:])